@@ -0,0 +1,158 @@
+# Per-stage timing metrics: low overhead histograms, JSON lines / Prometheus export and an overlay
+
+## reference
+# - https://prometheus.io/docs/instrumenting/exposition_formats/
+# - https://docs.python.org/3/library/http.server.html
+
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import cv2
+
+# Histogram bucket upper bounds in seconds, 10us .. ~10s in steps of about x1.5
+BUCKETS = tuple(1e-5 * 1.5 ** i for i in range(35))
+
+class Histogram:
+    '''Fixed-bucket latency histogram, recording is one bisect and a few adds'''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.last = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.last = seconds
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        '''Upper bound of the bucket holding the q-th percentile (0..100)'''
+        target = q / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return 0.0
+
+class _StageTimer:
+    '''Reusable context manager recording the time spent inside it.
+
+    Start times are kept on a per-thread stack, so threads timing the same
+    stage at once, or nested uses of one stage, each record their own span.
+    '''
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.local = threading.local()
+
+    def __enter__(self):
+        starts = getattr(self.local, 'starts', None)
+        if starts is None:
+            starts = self.local.starts = []
+        starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.record(time.perf_counter() - self.local.starts.pop())
+        return False
+
+class _NoTiming:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_TIMING = _NoTiming()
+
+class StageMetrics:
+    '''Named stage histograms, stages appear in the order they are first timed'''
+    def __init__(self):
+        self.histograms = {}
+        self.timers = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        '''Context manager timing one stage, e.g. with metrics.stage('flow'): ...'''
+        timer = self.timers.get(name)
+        if timer is None:
+            with self.lock:
+                timer = self.timers.get(name) # another thread may have added it meanwhile
+                if timer is None:
+                    self.histograms[name] = Histogram()
+                    timer = self.timers[name] = _StageTimer(self.histograms[name])
+                    self.order.append(name)
+        return timer
+
+    def record(self, name, seconds):
+        self.stage(name).histogram.record(seconds)
+
+    def snapshot(self):
+        '''Plain dict of per-stage statistics in milliseconds'''
+        stats = {}
+        for name in list(self.order):
+            h = self.histograms[name]
+            stats[name] = dict(count=h.count, mean_ms=1000.0 * h.mean(), last_ms=1000.0 * h.last,
+                               p50_ms=1000.0 * h.percentile(50), p99_ms=1000.0 * h.percentile(99))
+        return stats
+
+    def jsonLine(self):
+        return json.dumps(dict(time=time.time(), stages=self.snapshot()))
+
+    def prometheusText(self, prefix='optical_flow_stage_seconds'):
+        lines = ['# HELP %s Time spent per pipeline stage.' % prefix, '# TYPE %s histogram' % prefix]
+        for name in list(self.order):
+            h = self.histograms[name]
+            seen = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                seen += n
+                lines.append('%s_bucket{stage="%s",le="%.6g"} %d' % (prefix, name, bound, seen))
+            lines.append('%s_bucket{stage="%s",le="+Inf"} %d' % (prefix, name, h.count))
+            lines.append('%s_sum{stage="%s"} %.9f' % (prefix, name, h.sum))
+            lines.append('%s_count{stage="%s"} %d' % (prefix, name, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        '''Serve /metrics (Prometheus text) and /metrics.json from a daemon thread'''
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, kind = metrics.prometheusText(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, kind = metrics.jsonLine(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+def drawOverlay(img, metrics, stages=None):
+    '''Draw the live per-stage breakdown (last / mean ms) at the top left of img'''
+    color = 255 if img.ndim == 2 else (0, 255, 255)
+    y = 16
+    for name in stages or list(metrics.order):
+        h = metrics.histograms[name]
+        text = '%-10s %6.1f ms  avg %6.1f' % (name, 1000.0 * h.last, 1000.0 * h.mean())
+        cv2.putText(img, text, (8, y), cv2.FONT_HERSHEY_PLAIN, 1.0, color, 1, cv2.LINE_AA)
+        y += 16
+    return img
@@ -0,0 +1,145 @@
+# Compact append-only on-disk format for recorded flow fields, readable through a memory map
+
+## reference
+# - https://numpy.org/doc/stable/reference/generated/numpy.memmap.html
+# - https://numpy.org/doc/stable/user/basics.rec.html
+
+import json
+import os
+import time
+import numpy as np
+import cv2
+
+MAGIC = b'OFLOWREC'
+HEADER_SIZE = 512 # magic + JSON, padded so records start at a fixed offset
+VERSION = 1
+STORAGE = {'int16': '<i2', 'float16': '<f2'}
+
+# File layout:
+#   [HEADER_SIZE bytes] MAGIC, then JSON meta data padded with spaces
+#   [record] * n      fixed-size records, so frame i starts at HEADER_SIZE + i * record size
+# A record holds the timestamp, the dequantization scale and the (h, w, 2) flow, either
+# int16 (value * scale) or float16 (scale is 1). Records are appended a chunk at a time,
+# the frame count is the file size, so a file cut short by a crash stays readable.
+
+def recordType(meta):
+    '''Structured dtype of one frame record'''
+    return np.dtype([('time', '<f8'), ('scale', '<f4'), ('reserved', '<u4'),
+                     ('flow', STORAGE[meta['dtype']], (meta['height'], meta['width'], 2))])
+
+def _readMeta(f):
+    head = f.read(HEADER_SIZE)
+    if len(head) < HEADER_SIZE or not head.startswith(MAGIC):
+        raise IOError('not a flow record file')
+    meta = json.loads(head[len(MAGIC):].decode('utf-8'))
+    if meta['version'] > VERSION:
+        raise IOError('unsupported flow record version %d' % meta['version'])
+    return meta
+
+class FlowWriter:
+    '''Appends flow fields to a flow record file, chunk_frames records per write.
+
+    dtype is 'int16' (per-frame scaled, ~1/32767 of the largest vector) or
+    'float16'. grid > 1 stores a grid x grid times coarser field. An existing
+    file is appended to after its last complete record; shape, dtype and
+    grid default to its layout and must match it when given.
+    '''
+    def __init__(self, path, shape=None, dtype=None, grid=None, chunk_frames=32):
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            with open(path, 'rb') as f:
+                self.meta = _readMeta(f) # append to the existing recording
+            meta = self.meta
+            if shape is not None and tuple(shape[:2]) != (meta['full_height'], meta['full_width']):
+                raise ValueError('%s holds %dx%d flow, cannot append %dx%d' % (path, meta['full_width'],
+                                 meta['full_height'], shape[1], shape[0]))
+            if dtype is not None and dtype != meta['dtype']:
+                raise ValueError('%s holds %s flow, cannot append %s' % (path, meta['dtype'], dtype))
+            if grid is not None and grid != meta['grid']:
+                raise ValueError('%s holds flow on grid %d, cannot append grid %d' % (path, meta['grid'], grid))
+            # drop a record cut short by a crash, appending after it would shift all later ones
+            size = recordType(meta).itemsize
+            complete = HEADER_SIZE + (os.path.getsize(path) - HEADER_SIZE) // size * size
+            if complete < os.path.getsize(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(complete)
+        else:
+            if shape is None:
+                raise ValueError('shape is needed to create ' + path)
+            h, w = shape[:2]
+            dtype = dtype or 'int16'
+            grid = grid or 1
+            if dtype not in ('int16', 'float16'):
+                raise ValueError('dtype must be int16 or float16')
+            self.meta = dict(version=VERSION, dtype=dtype, grid=grid, full_height=h, full_width=w,
+                             height=(h + grid - 1) // grid, width=(w + grid - 1) // grid)
+            with open(path, 'wb') as f:
+                head = MAGIC + json.dumps(self.meta).encode('utf-8')
+                f.write(head.ljust(HEADER_SIZE, b' '))
+        self.file = open(path, 'ab')
+        self.chunk = np.zeros(chunk_frames, recordType(self.meta))
+        self.pending = 0
+
+    def write(self, flow, timestamp=None):
+        meta = self.meta
+        if flow.shape[:2] != (meta['full_height'], meta['full_width']):
+            raise ValueError('flow is %dx%d, the record holds %dx%d' % (flow.shape[1], flow.shape[0],
+                                                                       meta['full_width'], meta['full_height']))
+        if meta['grid'] > 1:
+            flow = cv2.resize(flow, (meta['width'], meta['height']), interpolation=cv2.INTER_AREA)
+        record = self.chunk[self.pending]
+        record['time'] = time.time() if timestamp is None else timestamp
+        if meta['dtype'] == 'int16':
+            scale = max(float(np.abs(flow).max()), 1e-3) / 32767.0
+            record['scale'] = scale
+            np.copyto(record['flow'], np.round(flow / scale), casting='unsafe')
+        else:
+            record['scale'] = 1.0
+            np.copyto(record['flow'], flow, casting='unsafe')
+        self.pending += 1
+        if self.pending == len(self.chunk):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.chunk[:self.pending].tobytes())
+        self.file.flush()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class FlowReader:
+    '''Random access to a flow record file through a memory map, nothing is loaded up front'''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.meta = _readMeta(f)
+        record = recordType(self.meta)
+        count = (os.path.getsize(path) - HEADER_SIZE) // record.itemsize
+        self.records = np.memmap(path, record, 'r', HEADER_SIZE, (count,)) if count else np.zeros(0, record)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def timestamps(self):
+        return self.records['time']
+
+    def frameAt(self, timestamp):
+        '''Index of the last frame recorded at or before timestamp'''
+        return max(0, int(np.searchsorted(self.timestamps, timestamp, side='right')) - 1)
+
+    def raw(self, index):
+        '''Stored (quantized, possibly coarse) flow and its scale, without copying'''
+        record = self.records[index]
+        return record['flow'], float(record['scale'])
+
+    def __getitem__(self, index):
+        '''Flow of frame index as float32, upsampled to the recorded frame size'''
+        flow, scale = self.raw(index)
+        flow = flow.astype(np.float32)
+        if self.meta['dtype'] == 'int16':
+            flow *= scale
+        if self.meta['grid'] > 1:
+            flow = cv2.resize(flow, (self.meta['full_width'], self.meta['full_height']),
+                              interpolation=cv2.INTER_LINEAR)
+        return flow
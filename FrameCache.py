@@ -0,0 +1,73 @@
+# Per-frame preprocessing cache shared by optical flow instances running on the same feed
+
+from collections import OrderedDict
+import cv2
+
+class _Entry:
+    def __init__(self, seq, frame):
+        self.seq = seq
+        self.frame = frame
+        self.gray = None
+        self.resized = {} # downscaled grays by (w, h)
+
+class FrameCache:
+    '''Gray image and downscaled grays of the last few frames, computed once.
+
+    Entries are keyed by a sequence number given out by push(), and found again
+    by frame identity, so every IOpticalFlow with cache set to the same object
+    shares the work done for a frame. Frames whose array is reused for new
+    content (e.g. FrameCapture.ThreadedCapture) must be push()ed each time.
+    Arrays handed out are read only, and an entry lives for the next
+    capacity - 1 frames.
+    '''
+    def __init__(self, capacity=4):
+        self.capacity = max(2, capacity) # previous and current frame at least
+        self.entries = OrderedDict() # seq -> _Entry, least recently used first
+        self.seq = 0
+        self.hits = 0
+        self.misses = 0
+
+    def push(self, frame):
+        '''Start a new entry for frame, returns its sequence number'''
+        for seq in [seq for seq, e in self.entries.items() if e.frame is frame]:
+            del self.entries[seq] # the array now holds another frame
+        self.seq += 1
+        self.entries[self.seq] = _Entry(self.seq, frame)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return self.seq
+
+    def __getitem__(self, seq):
+        return self.entries[seq]
+
+    def entry(self, frame):
+        '''Entry of frame, newest first, pushed when not cached yet'''
+        for e in reversed(self.entries.values()):
+            if e.frame is frame:
+                self.entries.move_to_end(e.seq)
+                return e
+        return self.entries[self.push(frame)]
+
+    def gray(self, frame):
+        '''Gray image of a BGR frame, or a copy of a gray one'''
+        e = self.entry(frame)
+        if e.gray is None:
+            self.misses += 1
+            e.gray = frame.copy() if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        else:
+            self.hits += 1
+        return e.gray
+
+    def resized(self, frame, size):
+        '''Gray image of frame downscaled to size (w, h) with INTER_AREA'''
+        gray = self.gray(frame)
+        if gray.shape[::-1] == tuple(size):
+            return gray
+        resized = self.entry(frame).resized
+        small = resized.get(tuple(size))
+        if small is None:
+            self.misses += 1
+            small = resized[tuple(size)] = cv2.resize(gray, tuple(size), interpolation=cv2.INTER_AREA)
+        else:
+            self.hits += 1
+        return small
@@ -0,0 +1,240 @@
+# Frame capture helpers: capture sources for cameras, files and synthetic feeds, and a
+# background capture thread keeping only the newest frames
+
+## reference
+# - https://docs.python.org/3/library/threading.html#condition-objects
+# - https://picamera.readthedocs.io/en/release-1.13/recipes2.html#unencoded-image-capture-yuv-format
+# - https://datasheets.raspberrypi.com/camera/picamera2-manual.pdf
+
+import threading
+import time
+import numpy as np
+import cv2
+
+class ThreadedCapture:
+    '''Reads a cv2.VideoCapture on a background thread into a small ring of reused buffers.
+
+    read() always returns the newest frame, frames the consumer was too slow
+    for are counted in dropped. A returned frame stays valid until the next
+    read(), copy it to keep it longer.
+    '''
+    def __init__(self, vc, flip=False, slots=3):
+        self.vc = vc
+        self.vc.set(cv2.CAP_PROP_BUFFERSIZE, 1) # hint for drivers to queue as little as possible
+        self.flip = flip
+        self.slots = max(3, slots) # one being written, one newest, one held by the consumer
+        self.ring = None
+        self.scratch = None
+        self.newest = -1  # slot of the newest frame
+        self.holding = -1 # slot returned by the last read()
+        self.fresh = False
+        self.running = True
+        self.captured = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            rval, self.scratch = self.vc.read(self.scratch)
+            if not rval:
+                break
+            if self.ring is None or self.ring[0].shape != self.scratch.shape:
+                self.ring = [np.empty_like(self.scratch) for _ in range(self.slots)]
+            with self.cond:
+                slot = next(i for i in range(self.slots) if i != self.newest and i != self.holding)
+            if self.flip:
+                cv2.flip(self.scratch, 1, dst=self.ring[slot])
+            else:
+                np.copyto(self.ring[slot], self.scratch)
+            with self.cond:
+                if self.fresh:
+                    self.dropped += 1
+                self.newest = slot
+                self.fresh = True
+                self.captured += 1
+                self.cond.notify()
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def read(self):
+        '''Wait for a frame newer than the last one returned, (False, None) once the capture ends'''
+        with self.cond:
+            while not self.fresh and self.running:
+                self.cond.wait()
+            if not self.fresh:
+                return False, None
+            self.fresh = False
+            self.holding = self.newest
+            return True, self.ring[self.holding]
+
+    def release(self):
+        self.running = False
+        self.thread.join()
+        self.vc.release()
+
+## capture sources, all read like cv2.VideoCapture: read() -> (ok, frame)
+# With gray=True a source returns 2D gray frames the flow classes take as is,
+# ideally straight from the sensor's luma plane without any color conversion.
+
+class OpenCVSource:
+    '''Camera index or video file/URL through cv2.VideoCapture'''
+    def __init__(self, source=0, size=None, gray=False):
+        if isinstance(source, str) and source.isdigit():
+            source = int(source)
+        self.vc = cv2.VideoCapture(source)
+        if size and isinstance(source, int):
+            self.vc.set(cv2.CAP_PROP_FRAME_WIDTH, size[0])
+            self.vc.set(cv2.CAP_PROP_FRAME_HEIGHT, size[1])
+        self.gray = gray
+        self.frame = None
+
+    def isOpened(self):
+        return self.vc.isOpened()
+
+    def set(self, prop, value):
+        return self.vc.set(prop, value)
+
+    def read(self, image=None):
+        if not self.gray:
+            return self.vc.read(image)
+        rval, self.frame = self.vc.read(self.frame)
+        if not rval:
+            return False, None
+        return True, cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY, dst=image)
+
+    def release(self):
+        self.vc.release()
+
+class PiCameraSource:
+    '''Raspberry Pi camera through the legacy picamera library.
+
+    Gray frames are the Y plane of raw YUV420 captures, no conversion at all.
+    '''
+    def __init__(self, source=None, size=(320, 240), gray=False, framerate=32):
+        from picamera import PiCamera
+        self.camera = PiCamera()
+        self.camera.resolution = size
+        self.camera.framerate = framerate
+        w, h = size
+        self.size = size
+        self.gray = gray
+        if gray:
+            # raw YUV420 rows are padded to 32 pixels, planes to 16 rows
+            self.stride, self.rows = (w + 31) // 32 * 32, (h + 15) // 16 * 16
+            self.buffer = np.empty(self.stride * self.rows * 3 // 2, np.uint8)
+            self.frames = self.camera.capture_continuous(self.buffer, format='yuv', use_video_port=True)
+        else:
+            from picamera.array import PiRGBArray
+            self.raw = PiRGBArray(self.camera, size=size)
+            self.frames = self.camera.capture_continuous(self.raw, format='bgr', use_video_port=True)
+        time.sleep(0.1) # wait for camera
+
+    def isOpened(self):
+        return not self.camera.closed
+
+    def set(self, prop, value):
+        return False
+
+    def read(self, image=None):
+        try:
+            next(self.frames)
+        except StopIteration:
+            return False, None
+        w, h = self.size
+        if self.gray:
+            return True, self.buffer[:self.stride * h].reshape(h, self.stride)[:, :w]
+        frame = self.raw.array
+        self.raw.truncate(0)
+        return True, frame
+
+    def release(self):
+        self.camera.close()
+
+class Picamera2Source:
+    '''Raspberry Pi camera through picamera2 (libcamera).
+
+    Gray frames are the Y plane of a YUV420 stream, a view into the capture
+    buffer, instead of RGB888 converted back to gray.
+    '''
+    def __init__(self, source=None, size=(320, 240), gray=False):
+        from picamera2 import Picamera2
+        self.camera = Picamera2()
+        self.size = size
+        self.gray = gray
+        config = self.camera.create_video_configuration(
+            main={'size': tuple(size), 'format': 'YUV420' if gray else 'RGB888'})
+        self.camera.configure(config)
+        self.camera.start()
+        time.sleep(1) # wait for camera to initialize
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        return False
+
+    def read(self, image=None):
+        array = self.camera.capture_array('main')
+        if array is None:
+            return False, None
+        if self.gray:
+            w, h = self.size
+            return True, array[:h, :w] # YUV420 comes as (h * 3 / 2, stride), Y on top
+        return True, array
+
+    def release(self):
+        self.camera.stop()
+        self.camera.close()
+
+class SyntheticSource:
+    '''Looping synthetic sequence (see SyntheticSequences), no camera needed'''
+    def __init__(self, source='sprites', size=(320, 240), gray=False, count=120, fps=30.0):
+        from SyntheticSequences import makeSequence
+        frames, _ = makeSequence(source or 'sprites', size[0], size[1], count)
+        if gray:
+            frames = [cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) for f in frames]
+        self.frames = frames
+        self.index = 0
+        self.interval = 1.0 / fps if fps else 0.0
+        self.due = time.time()
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        return False
+
+    def read(self, image=None):
+        # pace like a camera, frames would be dropped downstream otherwise
+        wait = self.due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.due = max(self.due, time.time() - self.interval) + self.interval
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+# backend name -> source class
+BACKENDS = {
+    'opencv': OpenCVSource,
+    'file': OpenCVSource,
+    'picamera': PiCameraSource,
+    'picamera2': Picamera2Source,
+    'synthetic': SyntheticSource,
+}
+
+def openCapture(backend='opencv', source=None, size=None, gray=False):
+    '''Capture source by backend name, source is a camera index, file, URL or synthetic sequence name.
+
+    Without size, OpenCV cameras keep their own resolution and other backends use 320x240.
+    '''
+    if backend in ('opencv', 'file'):
+        return OpenCVSource(0 if source is None else source, size, gray)
+    return BACKENDS[backend](source, size or (320, 240), gray)
@@ -0,0 +1,128 @@
+# Motion accumulator: motion energy and net displacement over a sliding window of frames
+
+import numpy as np
+import cv2
+from OpticalFlowShowcase import *
+
+class MotionAccumulator(IOpticalFlow):
+    '''Wraps a DenseOpticalFlow and sums its flow over the last window frames.
+
+    Every flow field is reduced to a grid of cell x cell pixel means, of the
+    flow (net displacement seen at that cell) and of its magnitude (motion
+    energy, pixels moved). The reduced frames go into a ring of window
+    float16 slots; the running sums get the new slot added and the oldest
+    subtracted, so an update costs the same whatever the window, and memory
+    is fixed by window and grid. float16 values add and subtract exactly in
+    float64 sums, which therefore do not drift. apply() renders the energy as
+    a heatmap over the frame. Unknown attributes are forwarded to the
+    wrapped object.
+    '''
+    def __init__(self, of, window=30, cell=8, scale=None, alpha=0.6):
+        if not getattr(of, 'flow_field', False):
+            raise ValueError('MotionAccumulator needs a dense flow type')
+        self.of = of
+        self.window = window
+        self.cell = cell
+        self.scale = scale # mean pixels per frame shown at full heat, None for the window maximum
+        self.alpha = alpha # heatmap opacity over the frame
+        self.shape = None
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['of'], name)
+
+    def __len__(self):
+        '''Frames in the window'''
+        return self.count
+
+    def reset(self, shape):
+        '''Empty the window for frames of shape'''
+        h, w = shape[:2]
+        self.shape = (h, w)
+        self.grid = gh, gw = (max(1, h // self.cell), max(1, w // self.cell))
+        self.ring_flow = np.zeros((self.window, gh, gw, 2), np.float16)
+        self.ring_energy = np.zeros((self.window, gh, gw), np.float16)
+        self.sum_flow = np.zeros((gh, gw, 2), np.float64)
+        self.sum_energy = np.zeros((gh, gw), np.float64)
+        self.fx = np.empty((h, w), np.float32)
+        self.fy = np.empty((h, w), np.float32)
+        self.mag = np.empty((h, w), np.float32)
+        self.head = 0
+        self.count = 0
+
+    def set1stFrame(self, frame):
+        self.of.set1stFrame(frame)
+        self.reset(frame.shape)
+
+    def add(self, flow):
+        '''Push one flow field into the window, dropping the oldest once full'''
+        if self.shape != flow.shape[:2]:
+            self.reset(flow.shape)
+        gh, gw = self.grid
+        cv2.extractChannel(flow, 0, dst=self.fx)
+        cv2.extractChannel(flow, 1, dst=self.fy)
+        cv2.magnitude(self.fx, self.fy, magnitude=self.mag)
+        slot = self.head
+        if self.count == self.window:
+            self.sum_flow -= self.ring_flow[slot]
+            self.sum_energy -= self.ring_energy[slot]
+        else:
+            self.count += 1
+        self.ring_flow[slot] = cv2.resize(flow, (gw, gh), interpolation=cv2.INTER_AREA)
+        self.ring_energy[slot] = cv2.resize(self.mag, (gw, gh), interpolation=cv2.INTER_AREA)
+        self.sum_flow += self.ring_flow[slot]
+        self.sum_energy += self.ring_energy[slot]
+        self.head = (slot + 1) % self.window
+
+    def compute(self, frame):
+        '''Advance the wrapped flow to frame and accumulate it, returns its gray image and flow'''
+        next, flow = self.of.compute(frame)
+        with self.stage('accumulate'):
+            self.add(flow)
+        return next, flow
+
+    def apply(self, frame):
+        next, flow = self.compute(frame)
+        with self.stage('render'):
+            return self.heatmap(next)
+
+    def analyze(self, frame, render=False, **kwargs):
+        '''Flow and motion statistics of the frame, with the window energy and displacement grids'''
+        next, flow = self.compute(frame)
+        result = dict(flow=flow, stats=flowStats(flow, **kwargs), energy=self.energy(),
+                      displacement=self.displacement(), image=None)
+        if render:
+            with self.stage('render'):
+                result['image'] = self.heatmap(next)
+        return result
+
+    ## queries, grids are (rows, cols) of cells of about cell x cell pixels
+    def energy(self, mean=False):
+        '''Pixels moved per cell over the window, or per frame with mean'''
+        return np.float32(self.sum_energy / max(self.count, 1) if mean else self.sum_energy)
+
+    def displacement(self, mean=False):
+        '''Net (dx, dy) per cell over the window, or per frame with mean'''
+        return np.float32(self.sum_flow / max(self.count, 1) if mean else self.sum_flow)
+
+    def cells(self, x0, y0, x1, y1):
+        '''Cell index ranges (rows, cols) overlapping the frame rectangle [x0, x1) x [y0, y1)'''
+        (h, w), (gh, gw) = self.shape, self.grid
+        r0, r1 = min(gh - 1, max(0, y0 * gh // h)), min(gh, max(1, -(-y1 * gh // h)))
+        c0, c1 = min(gw - 1, max(0, x0 * gw // w)), min(gw, max(1, -(-x1 * gw // w)))
+        return slice(r0, max(r0 + 1, r1)), slice(c0, max(c0 + 1, c1))
+
+    def region(self, x0, y0, x1, y1):
+        '''Window motion within a frame rectangle: mean energy and mean net displacement of its cells'''
+        rows, cols = self.cells(x0, y0, x1, y1)
+        return dict(frames=self.count, energy=float(self.sum_energy[rows, cols].mean()),
+                    displacement=tuple(float(v) for v in self.sum_flow[rows, cols].mean(axis=(0, 1))))
+
+    def heatmap(self, grayFrame):
+        '''Mean motion energy of the window as a color map blended over the frame'''
+        energy = self.energy(mean=True)
+        top = self.scale or max(float(energy.max()), 1e-3)
+        heat = cv2.applyColorMap(cv2.convertScaleAbs(energy, alpha=255.0 / top), cv2.COLORMAP_JET)
+        h, w = grayFrame.shape[:2]
+        heat = cv2.resize(heat, (w, h), interpolation=cv2.INTER_LINEAR)
+        base = grayFrame if grayFrame.ndim == 3 else cv2.cvtColor(grayFrame, cv2.COLOR_GRAY2BGR)
+        return cv2.addWeighted(base, 1.0 - self.alpha, heat, self.alpha, 0.0)
@@ -0,0 +1,58 @@
+# Motion statistics from flow fields or tracked point pairs, for consumers that want numbers not images
+
+import numpy as np
+import cv2
+
+def motionStats(vectors, positions, shape, grid=(4, 4), angle_bins=8,
+                magnitude_edges=(0.5, 1, 2, 4, 8, 16)):
+    '''Cheap statistics of N motion vectors (dx, dy) found at N (x, y) positions in a frame of shape.
+
+    mean       - global mean motion (dx, dy) in pixels per frame
+    magnitude  - mean motion magnitude
+    direction  - dominant direction in degrees (0 = +x, 90 = +y, image coordinates),
+                 the angle bin holding the most motion magnitude
+    histogram  - counts per (angle bin, magnitude bin), magnitude bins split at magnitude_edges
+    energy     - mean squared magnitude per cell of a (rows, cols) grid over the frame
+    '''
+    vectors = np.asarray(vectors, np.float32).reshape(-1, 2)
+    positions = np.asarray(positions, np.float32).reshape(-1, 2)
+    rows, cols = grid
+    h, w = shape[:2]
+    stats = dict(count=len(vectors), mean=(0.0, 0.0), magnitude=0.0, direction=None,
+                 histogram=np.zeros((angle_bins, len(magnitude_edges) + 1), np.int64),
+                 energy=np.zeros(grid, np.float32))
+    if len(vectors) == 0:
+        return stats
+
+    mag, ang = cv2.cartToPolar(vectors[:, 0], vectors[:, 1], angleInDegrees=True)
+    mag, ang = mag.ravel(), ang.ravel()
+    abin = np.int64(ang * angle_bins / 360.0) % angle_bins
+    mbin = np.searchsorted(magnitude_edges, mag)
+    stats['histogram'] = np.bincount(abin * (len(magnitude_edges) + 1) + mbin,
+                                     minlength=stats['histogram'].size).reshape(stats['histogram'].shape)
+    weight = np.bincount(abin, weights=mag, minlength=angle_bins)
+    if weight.max() > 0:
+        stats['direction'] = (np.argmax(weight) + 0.5) * 360.0 / angle_bins
+
+    cell = (np.clip(np.int64(positions[:, 1] * rows / h), 0, rows - 1) * cols +
+            np.clip(np.int64(positions[:, 0] * cols / w), 0, cols - 1))
+    total = np.bincount(cell, weights=mag * mag, minlength=rows * cols)
+    count = np.bincount(cell, minlength=rows * cols)
+    stats['energy'] = np.float32(total / np.maximum(count, 1)).reshape(grid)
+
+    stats['mean'] = tuple(float(v) for v in vectors.mean(axis=0))
+    stats['magnitude'] = float(mag.mean())
+    return stats
+
+def flowStats(flow, stride=4, **kwargs):
+    '''motionStats() of a dense flow field sampled every stride pixels'''
+    h, w = flow.shape[:2]
+    y, x = np.mgrid[stride//2:h:stride, stride//2:w:stride]
+    sample = flow[stride//2::stride, stride//2::stride]
+    return motionStats(sample, np.dstack([x, y]), flow.shape, **kwargs)
+
+def pointStats(old, new, shape, **kwargs):
+    '''motionStats() of tracked point pairs'''
+    old = np.asarray(old, np.float32).reshape(-1, 2)
+    new = np.asarray(new, np.float32).reshape(-1, 2)
+    return motionStats(new - old, old, shape, **kwargs)
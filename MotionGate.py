@@ -0,0 +1,154 @@
+# Motion gate: skips optical flow while the scene is static
+
+import time
+import numpy as np
+import cv2
+from OpticalFlowShowcase import *
+
+class MotionGate(IOpticalFlow):
+    '''Wraps an IOpticalFlow and only runs it while something in the frame changes.
+
+    Every frame is shrunk to size and compared with the last frame flow ran
+    on, the score is the largest mean absolute difference over block x block
+    cells (gray levels). The gate opens when the score passes open_threshold
+    and closes after hold frames below close_threshold. While closed, apply()
+    returns the last render, flow is zero and the wrapped object is not
+    touched. flow is only there when the flow object inside the wrappers
+    leaves a dense field. Unknown attributes are forwarded to the wrapped
+    object.
+    '''
+    def __init__(self, of, open_threshold=6.0, close_threshold=3.0, hold=5, size=(80, 60), block=8):
+        self.of = of
+        self.dense = getattr(unwrap(of), 'flow_field', False)
+        self.open_threshold = open_threshold
+        self.close_threshold = close_threshold
+        self.hold = hold
+        self.size = size
+        self.cells = (max(1, size[0] // block), max(1, size[1] // block))
+        self.small = np.empty(size[::-1] + (3,), np.uint8)
+        self.gray = np.empty(size[::-1], np.uint8)
+        self.reference = np.empty(size[::-1], np.uint8)
+        self.diff = np.empty(size[::-1], np.uint8)
+        self.blocks = np.empty(self.cells[::-1], np.uint8)
+        self.render = None
+        self.output = None
+        self.static = None
+        self.open = True
+        self.quiet = 0
+        self.skipping = False
+        # gate statistics, see stats()
+        self.frames = 0
+        self.skipped = 0
+        self.score = 0.0
+        self.latency = None # EMA of the wrapped apply(), to estimate the time saved
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['of'], name)
+
+    @property
+    def flow(self):
+        '''Flow of the last frame, zero while the gate is closed, None for point tracking types'''
+        if not self.dense:
+            return None
+        if self.skipping:
+            return self.static['flow']
+        return self.of.flow
+
+    def set1stFrame(self, frame):
+        self.of.set1stFrame(frame)
+        self.measure(frame)
+        self.reference, self.gray = self.gray, self.reference
+        self.open = True
+        self.quiet = 0
+        self.skipping = False
+
+    def measure(self, frame):
+        '''Block SAD score of frame against the reference, leaves its small gray image in self.gray'''
+        if frame.ndim == 2:
+            cv2.resize(frame, self.size, dst=self.gray, interpolation=cv2.INTER_AREA)
+        else:
+            cv2.resize(frame, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        cv2.absdiff(self.gray, self.reference, dst=self.diff)
+        cv2.resize(self.diff, self.cells, dst=self.blocks, interpolation=cv2.INTER_AREA)
+        return float(self.blocks.max())
+
+    def gate(self, frame):
+        '''Decide with hysteresis whether flow runs on frame'''
+        with self.stage('gate'):
+            self.score = score = self.measure(frame)
+        if not self.open:
+            self.open = score > self.open_threshold
+            self.quiet = 0
+        elif score < self.close_threshold:
+            self.quiet += 1
+            self.open = self.quiet < self.hold
+        else:
+            self.quiet = 0
+        self.frames += 1
+        self.skipping = not self.open
+        if self.skipping:
+            self.skipped += 1
+        else:
+            self.reference, self.gray = self.gray, self.reference
+        return self.open
+
+    def staticResult(self, frame):
+        '''Zero motion result for frames of this shape, made once'''
+        if self.static is None or self.static['shape'] != frame.shape:
+            flow = np.zeros(frame.shape[:2] + (2,), np.float32) if self.dense else None
+            none = np.zeros((0, 2), np.float32)
+            if self.dense:
+                stats = flowStats(flow)
+            else:
+                stats = pointStats(none, none, frame.shape)
+            self.static = dict(shape=frame.shape, flow=flow, old=none, new=none, stats=stats)
+        return self.static
+
+    def cachedRender(self, frame):
+        '''Copy of the last render, so drawing on the result does not touch the cache'''
+        if self.render is None:
+            return frame.copy()
+        if self.output is None or self.output.shape != self.render.shape:
+            self.output = np.empty_like(self.render)
+        np.copyto(self.output, self.render)
+        return self.output
+
+    def keep(self, img):
+        '''Remember a render of the wrapped object, which may reuse its buffer next time'''
+        if self.render is None or self.render.shape != img.shape:
+            self.render = img.copy()
+        else:
+            np.copyto(self.render, img)
+
+    def apply(self, frame):
+        if not self.gate(frame):
+            self.staticResult(frame)
+            return self.cachedRender(frame)
+        start = time.perf_counter()
+        img = self.of.apply(frame)
+        elapsed = time.perf_counter() - start
+        self.latency = elapsed if self.latency is None else 0.9 * self.latency + 0.1 * elapsed
+        self.keep(img)
+        return img
+
+    def analyze(self, frame, render=False, **kwargs):
+        if not self.gate(frame):
+            static = self.staticResult(frame)
+            result = dict(stats=static['stats'], image=self.cachedRender(frame) if render else None)
+            for key in (('flow',) if self.dense else ('old', 'new')):
+                result[key] = static[key]
+            return result
+        result = self.of.analyze(frame, render, **kwargs)
+        if result['image'] is not None:
+            self.keep(result['image'])
+        return result
+
+    def hitRate(self):
+        '''Fraction of frames the gate skipped'''
+        return self.skipped / float(self.frames) if self.frames else 0.0
+
+    def stats(self):
+        '''Gate statistics, saved_s estimates the compute time skipped frames would have taken'''
+        return dict(frames=self.frames, skipped=self.skipped, hit_rate=self.hitRate(), score=self.score,
+                    open=self.open, saved_s=self.skipped * (self.latency or 0.0))
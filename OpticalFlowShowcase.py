@@ -7,11 +7,268 @@
 # http://www.yuml.me/diagram/scruffy/class/draw
 # [IOpticalFlow]^[DenseOpticalFlow],[IOpticalFlow]^[LucasKanadeOpticalFlow], [DenseOpticalFlow]^[DenseOpticalFlowByHSV],[DenseOpticalFlow]^[DenseOpticalFlowByLines],[DenseOpticalFlow]^[DenseOpticalFlowByWarp]
 
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
+from FlowMetrics import NO_TIMING
+from MotionAnalytics import flowStats, pointStats
+from SyntheticSequences import makeSequence
+
+## batched drawing, a handful of NumPy operations instead of one cv2 call per glyph
+_brushes = {}
+
+def brushOffsets(radius):
+    '''(dy, dx) pixel offsets of a filled cv2.circle of this radius, cached'''
+    if radius not in _brushes:
+        canvas = np.zeros((2 * radius + 1, 2 * radius + 1), np.uint8)
+        cv2.circle(canvas, (radius, radius), radius, 255, -1)
+        dy, dx = np.nonzero(canvas)
+        _brushes[radius] = (dy - radius, dx - radius)
+    return _brushes[radius]
+
+def dotPixels(centers, radius, shape):
+    '''Flat pixel indices covered by filled circles at integer (x, y) centers, clipped to shape.
+
+    Also returns which center each pixel belongs to, for per-dot colors.
+    '''
+    h, w = shape[:2]
+    dy, dx = brushOffsets(radius)
+    ys = centers[:, 1, np.newaxis] + dy
+    xs = centers[:, 0, np.newaxis] + dx
+    inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+    owner = np.broadcast_to(np.arange(len(centers))[:, np.newaxis], ys.shape)
+    return ys[inside] * w + xs[inside], owner[inside]
+
+def drawDots(img, centers, radius, color):
+    '''Filled circles at (x, y) centers, color is one BGR tuple or an array with one row per center'''
+    centers = np.int32(np.round(np.asarray(centers, np.float32).reshape(-1, 2)))
+    pixels, owner = dotPixels(centers, radius, img.shape)
+    color = np.asarray(color)
+    img.reshape(img.shape[0] * img.shape[1], -1)[pixels] = color if color.ndim <= 1 else color[owner]
+    return img
+
+def drawSegments(img, p0, p1, color, thickness=1):
+    '''Line segments p0[i] -> p1[i], rasterized all at once by sampling along each segment'''
+    p0 = np.asarray(p0, np.float32).reshape(-1, 2)
+    p1 = np.asarray(p1, np.float32).reshape(-1, 2)
+    if len(p0) == 0:
+        return img
+    # each segment gets one sample per pixel of its own length, so a long one does not slow the rest
+    steps = np.int64(np.ceil(np.abs(p1 - p0).max(axis=1))) + 1
+    owner = np.repeat(np.arange(len(p0)), steps)
+    t = np.arange(len(owner)) - np.repeat(np.cumsum(steps) - steps, steps)
+    t = (t / np.maximum(steps - 1, 1)[owner]).astype(np.float32)[:, np.newaxis]
+    points = p0[owner] + t * (p1 - p0)[owner]
+    color = np.asarray(color)
+    if color.ndim > 1:
+        color = color[owner]
+    return drawDots(img, points, thickness // 2, color)
+
+## tiled Farneback, tiles run on a thread pool as OpenCV releases the GIL
+_pool = None
+
+def flowPool():
+    '''Thread pool shared by all tiled flow computations'''
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(os.cpu_count() or 4)
+    return _pool
+
+def tileMargin(params):
+    '''Overlap needed around a tile for Farneback to see the same neighborhood as on the whole frame'''
+    support = params['winsize'] // 2 + params['poly_n']
+    return int(np.ceil(support / params['pyr_scale'] ** (params['levels'] - 1)))
+
+def _tileWeights(start, stop, lo, hi, size, band):
+    '''1D blend weights over [lo, hi) for a tile owning [start, stop), ramping across +-band at inner edges'''
+    x = np.arange(lo, hi, dtype=np.float32) + 0.5
+    w = np.ones(hi - lo, np.float32)
+    if start > 0:
+        w = np.minimum(w, np.clip((x - (start - band)) / (2.0 * band), 0, 1))
+    if stop < size:
+        w = np.minimum(w, np.clip(((stop + band) - x) / (2.0 * band), 0, 1))
+    return w
+
+def calcFlowTiled(prev, next, flow, params, tiles):
+    '''Farneback flow computed on (rows, cols) overlapping tiles in parallel and blended into one field'''
+    h, w = next.shape[:2]
+    rows, cols = tiles
+    margin = tileMargin(params)
+    band = max(1, margin // 2)
+    initial = flow is not None and params['flags'] & cv2.OPTFLOW_USE_INITIAL_FLOW
+
+    def one(y0, y1, x0, x1, ey0, ey1, ex0, ex1, init):
+        tile = cv2.calcOpticalFlowFarneback(prev[ey0:ey1, ex0:ex1], next[ey0:ey1, ex0:ex1], init, **params)
+        weight = np.outer(_tileWeights(y0, y1, ey0, ey1, h, band), _tileWeights(x0, x1, ex0, ex1, w, band))
+        tile *= weight[..., np.newaxis]
+        return (ey0, ey1, ex0, ex1), tile
+
+    jobs = []
+    for r in range(rows):
+        for c in range(cols):
+            y0, y1 = h * r // rows, h * (r + 1) // rows
+            x0, x1 = w * c // cols, w * (c + 1) // cols
+            ey0, ey1 = max(0, y0 - margin), min(h, y1 + margin)
+            ex0, ex1 = max(0, x0 - margin), min(w, x1 + margin)
+            # copied here, flow is cleared below while the jobs still run
+            init = flow[ey0:ey1, ex0:ex1].copy() if initial else None
+            jobs.append(flowPool().submit(one, y0, y1, x0, x1, ey0, ey1, ex0, ex1, init))
+    if flow is None:
+        flow = np.zeros((h, w, 2), np.float32)
+    else:
+        flow[...] = 0
+    for job in jobs:
+        (ey0, ey1, ex0, ex1), tile = job.result()
+        flow[ey0:ey1, ex0:ex1] += tile
+    return flow
+
+## region of interest flow, dense flow computed only where something moves
+def activeRegions(prev, next, block=16, threshold=4.0, mask=None):
+    '''Rectangles (x0, y0, x1, y1) around the active blocks of a frame pair, padded by one block.
+
+    A block x block cell is active when the mean absolute difference of prev
+    and next over it passes threshold (gray levels), or, given a mask of the
+    frame size, when any of its pixels is nonzero in the mask. Neighboring
+    active cells form one rectangle and overlapping rectangles are merged.
+    '''
+    h, w = next.shape[:2]
+    cells = (max(1, w // block), max(1, h // block))
+    if mask is None:
+        diff = cv2.absdiff(prev, next)
+        active = cv2.resize(diff, cells, interpolation=cv2.INTER_AREA) > threshold
+    else:
+        active = cv2.resize(np.uint8(mask != 0) * 255, cells, interpolation=cv2.INTER_AREA) > 0
+    grown = cv2.dilate(np.uint8(active), np.ones((3, 3), np.uint8))
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(grown, connectivity=8)
+    rects = [(x, y, x + bw, y + bh) for x, y, bw, bh, area in stats[1:]]
+    merged = True
+    while merged: # bounding boxes of separate groups may still overlap
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    cw, ch = cells
+    return [(int(x0) * w // cw, int(y0) * h // ch, int(x1) * w // cw, int(y1) * h // ch) for x0, y0, x1, y1 in rects]
+
+## flow engines, DenseOpticalFlow computes its flow with one of these
+class FarnebackEngine:
+    '''Gunnar Farneback flow with the owner's farneback_params, warm start and tiles'''
+    def calc(self, of, prev, next):
+        params = of.farneback_params
+        init = of.small_flow
+        flow = of.buffer('flow%d' % of.parity, next.shape + (2,), np.float32)
+        if of.warm_start and init is not None and init.shape[:2] == next.shape[:2]:
+            params = dict(params, flags=params['flags'] | cv2.OPTFLOW_USE_INITIAL_FLOW)
+            if flow is None:
+                flow = init.copy()
+            else:
+                np.copyto(flow, init)
+        if of.tiles:
+            return calcFlowTiled(prev, next, flow, params, of.tiles)
+        return cv2.calcOpticalFlowFarneback(prev, next, flow, **params)
+
+class DISEngine:
+    '''Dense Inverse Search flow (cv2.DISOpticalFlow) with one of its speed presets'''
+    def __init__(self, preset=cv2.DISOPTICAL_FLOW_PRESET_FAST):
+        self.dis = cv2.DISOpticalFlow_create(preset)
+
+    def calc(self, of, prev, next):
+        init = of.small_flow
+        if of.warm_start and init is not None and init.shape[:2] == next.shape[:2]:
+            # DIS starts from any flow passed in, so only pass one to warm start
+            flow = of.buffer('flow%d' % of.parity, next.shape + (2,), np.float32)
+            if flow is None:
+                flow = init.copy()
+            else:
+                np.copyto(flow, init)
+            return self.dis.calc(prev, next, flow)
+        return self.dis.calc(prev, next, None)
+
+class GridLKEngine:
+    '''Pyramidal Lucas-Kanade on a point grid every step pixels, interpolated to a dense field'''
+    def __init__(self, step=8):
+        self.step = step
+        self.lk_params = dict(winSize=(15, 15), maxLevel=3,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.grid = None
+
+    def calc(self, of, prev, next):
+        h, w = next.shape[:2]
+        if self.grid is None or self.grid_shape != (h, w):
+            y, x = np.mgrid[self.step//2:h:self.step, self.step//2:w:self.step]
+            self.grid = np.float32(np.dstack([x, y])).reshape(-1, 1, 2)
+            self.grid_shape = (h, w)
+            self.cells = x.shape
+        p1, st, err = cv2.calcOpticalFlowPyrLK(prev, next, self.grid, None, **self.lk_params)
+        motion = p1 - self.grid
+        motion[st.ravel() == 0] = 0 # lost points count as still
+        motion = motion.reshape(self.cells + (2,))
+        return cv2.resize(motion, (w, h), dst=of.buffer('flow%d' % of.parity, (h, w, 2), np.float32),
+                          interpolation=cv2.INTER_LINEAR)
+
+# engine name -> factory, add more with registerEngine()
+ENGINES = {
+    'farneback': FarnebackEngine,
+    'dis_ultrafast': lambda: DISEngine(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST),
+    'dis_fast': lambda: DISEngine(cv2.DISOPTICAL_FLOW_PRESET_FAST),
+    'dis_medium': lambda: DISEngine(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM),
+    'pyrlk_grid': GridLKEngine,
+}
+
+def registerEngine(name, factory):
+    '''Make a flow engine available by name, factory() returns an object with calc(of, prev, next)'''
+    ENGINES[name] = factory
+
+_selected = {}
+
+def benchmarkEngines(engines=None, size=(320, 240), frames=8, sequences=('rotate', 'sprites')):
+    '''Mean ms per frame and end-point error of each engine on synthetic sequences with known flow'''
+    border = 16 # flow is undefined where content enters the frame
+    data = [makeSequence(name, size[0], size[1], frames) for name in sequences]
+    results = {}
+    for name in engines or ENGINES:
+        elapsed, errors = 0.0, []
+        for seq_frames, flows in data:
+            of = DenseOpticalFlow(engine=name)
+            of.set1stFrame(seq_frames[0])
+            for frame, gt in zip(seq_frames[1:], flows):
+                start = time.perf_counter()
+                of.compute(frame)
+                elapsed += time.perf_counter() - start
+                errors.append(np.linalg.norm(of.flow - gt, axis=2)[border:-border, border:-border].mean())
+        results[name] = dict(ms=1000.0 * elapsed / len(errors), epe=float(np.mean(errors)))
+    return results
+
+def selectEngine(max_epe=0.25, engines=None, **kwargs):
+    '''Fastest engine within max_epe pixels of ground truth on this machine, measured once per process'''
+    key = (max_epe, tuple(engines or ENGINES), tuple(sorted(kwargs.items())))
+    if key not in _selected:
+        results = benchmarkEngines(engines, **kwargs)
+        good = [name for name in results if results[name]['epe'] <= max_epe]
+        if good:
+            _selected[key] = min(good, key=lambda name: results[name]['ms'])
+        else:
+            _selected[key] = min(results, key=lambda name: results[name]['epe'])
+    return _selected[key]
 
 class IOpticalFlow:
-    '''Interface of OpticalFlow classes'''
+    '''Interface of OpticalFlow classes, frames are BGR or already gray (2D)'''
+    metrics = None # set a FlowMetrics.StageMetrics to time the stages of apply()
+    cache = None   # set a FrameCache.FrameCache shared by instances on the same feed
+
+    def stage(self, name):
+        '''Timing context for one stage of apply(), a no-op unless metrics is set'''
+        return NO_TIMING if self.metrics is None else self.metrics.stage(name)
+
     def set1stFrame(self, frame):
         '''Set the starting frame'''
         self.prev = frame
@@ -24,58 +281,452 @@ class IOpticalFlow:
 
 class DenseOpticalFlow(IOpticalFlow):
     '''Abstract class for DenseOpticalFlow expressions'''
+    flow_field = True # leaves a full frame flow field in .flow after every frame
+
+    def __init__(self, scale=1.0, warm_start=False, reuse_buffers=False, tiles=None, engine='farneback',
+                 decimate=1, max_error=None, regions=None):
+        # flow engine by name in ENGINES, 'auto' picks the fastest accurate one with selectEngine()
+        if engine == 'auto':
+            engine = selectEngine()
+        self.engine_name = engine
+        self.engine = ENGINES[engine]()
+
+        # compute flow at this fraction of the frame size, e.g. 0.25 for 1/16 of the pixels
+        self.scale = scale
+
+        # split the frame into (rows, cols) overlapping Farneback tiles computed in parallel, e.g. (2, 4)
+        self.tiles = tiles
+
+        # Parameters for Gunnar Farneback optical flow
+        self.farneback_params = dict( pyr_scale = 0.5,
+                                      levels = 3,
+                                      winsize = 15,
+                                      iterations = 3,
+                                      poly_n = 5,
+                                      poly_sigma = 1.2,
+                                      flags = 0 )
+
+        # start from the previous flow, converges in fewer iterations on smooth motion
+        self.warm_start = warm_start
+        self.small_flow = None
+
+        # compute flow on every decimate-th frame only and extrapolate it (constant velocity) in between;
+        # with max_error (pixels) the interval adapts, up to decimate, to how fast the flow changes
+        self.decimate = decimate
+        self.max_error = max_error
+        self.interval = 1 if max_error else decimate
+        self.drift = None # measured change of the flow per frame, pixels
+        self.key_sample = None
+        self.since_key = 0
+        self.flow = None
+
+        # compute flow only on rectangles around active regions and leave it zero elsewhere: 'motion' finds
+        # them by frame difference, a mask of the frame size (nonzero = active) gives them
+        self.regions = regions
+        self.region_block = 16       # cell size of the activity test, pixels at compute resolution
+        self.region_threshold = 4.0  # mean absolute difference of an active cell, gray levels
+        self.region_pad = 16         # context computed around each rectangle, pixels
+        self.region_full = 0.75      # compute the whole frame once the padded rectangles cover this fraction
+        self.rects = []              # rectangles of the last computed frame
+        self.active = 1.0            # pixels flow was computed on over frame pixels
+
+        # write every intermediate into cached arrays, apply() then returns a reused
+        # image that is only valid until the next call
+        self.reuse_buffers = reuse_buffers
+        self.buffers = {}
+        self.parity = 0 # selects which of the double buffers holds the next frame
+
     def set1stFrame(self, frame):
-        self.prev = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        self.hsv = np.zeros_like(frame)
+        self.prev = self.prepare(frame)[1]
+        self.parity ^= 1
+        self.small_flow = None
+        self.flow = None
+        self.hsv = np.zeros(frame.shape[:2] + (3,), np.uint8)
         self.hsv[..., 1] = 255
 
     def apply(self, frame):
-        next = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        flow = cv2.calcOpticalFlowFarneback(self.prev, next, None,
-                                            0.5, 3, 15, 3, 5, 1.2, 0)
+        next, flow = self.compute(frame)
+        with self.stage('render'):
+            return self.makeResult(next, flow)
 
-        result = self.makeResult(next, flow)
-        self.prev = next
+    def analyze(self, frame, render=False, **kwargs):
+        '''Flow and motion statistics (see MotionAnalytics.motionStats) without rendering unless asked'''
+        next, flow = self.compute(frame)
+        result = dict(flow=flow, stats=flowStats(flow, **kwargs), image=None)
+        if render:
+            with self.stage('render'):
+                result['image'] = self.makeResult(next, flow)
         return result
 
+    def compute(self, frame):
+        '''Advance to frame, returns its gray image and the flow from the previous frame'''
+        with self.stage('gray'):
+            next, small = self.prepare(frame)
+            if self.prev.shape != small.shape: # scale changed since the last frame
+                self.prev = cv2.resize(self.prev, small.shape[::-1], interpolation=cv2.INTER_AREA)
+
+        self.since_key += 1
+        if self.flow is None or self.since_key >= self.interval or self.flow.shape[:2] != next.shape[:2]:
+            with self.stage('flow'):
+                flow = self.calcFlow(self.prev, small)
+                self.small_flow = flow
+                flow = self.expand(flow, next.shape)
+            if self.max_error:
+                self.schedule(flow)
+            self.since_key = 0
+        else:
+            flow = self.flow # motion per frame held since the last computed frame
+
+        self.prev = small
+        self.parity ^= 1
+        self.flow = flow # raw flow of the last frame, for headless consumers
+        return next, flow
+
+    def schedule(self, flow):
+        '''Pick the next keyframe interval so extrapolation drifts less than max_error pixels'''
+        sample = flow[::8, ::8]
+        if self.key_sample is not None and self.key_sample.shape == sample.shape:
+            spacing = self.since_key # frames since the previous computed flow, counted in compute()
+            self.drift = float(np.linalg.norm(sample - self.key_sample, axis=2).mean()) / spacing
+            self.interval = max(1, min(self.decimate, int(self.max_error / max(self.drift, 1e-6))))
+            np.copyto(self.key_sample, sample)
+        else:
+            self.key_sample = sample.copy()
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        '''Cached scratch array in reuse_buffers mode, otherwise None to let OpenCV/NumPy allocate'''
+        if not self.reuse_buffers:
+            return None
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.buffers[name] = np.empty(shape, dtype)
+        return buf
+
+    def prepare(self, frame):
+        '''Gray image of frame and its copy at compute resolution, from the shared cache if set'''
+        if self.cache is not None:
+            return self.cache.gray(frame), self.cache.resized(frame, self.smallSize(frame.shape))
+        gray = self.toGray(frame)
+        return gray, self.shrink(gray)
+
+    def toGray(self, frame):
+        '''Gray image of a BGR frame, or a copy of a gray one as capture buffers get reused'''
+        dst = self.buffer('gray%d' % self.parity, frame.shape[:2])
+        if frame.ndim == 2:
+            if dst is None:
+                return frame.copy()
+            np.copyto(dst, frame)
+            return dst
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+
+    def calcFlow(self, prev, next):
+        '''Flow between two gray frames at compute resolution, by the engine'''
+        if self.regions is None:
+            return self.engine.calc(self, prev, next)
+        return self.calcFlowRegions(prev, next)
+
+    def calcFlowRegions(self, prev, next):
+        '''Engine flow on the active rectangles only (see activeRegions), zero elsewhere'''
+        h, w = next.shape[:2]
+        mask = None if isinstance(self.regions, str) else self.regionMask(next.shape)
+        self.rects = activeRegions(prev, next, self.region_block, self.region_threshold, mask)
+        pad = self.region_pad
+        padded = [(max(0, x0 - pad), max(0, y0 - pad), min(w, x1 + pad), min(h, y1 + pad))
+                  for x0, y0, x1, y1 in self.rects]
+        self.active = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in padded) / float(h * w)
+        if self.active >= self.region_full: # little to save, and the whole frame is more accurate
+            self.rects, self.active = [(0, 0, w, h)], 1.0
+            return self.engine.calc(self, prev, next)
+
+        flow = self.buffer('region_flow%d' % self.parity, (h, w, 2), np.float32)
+        if flow is None:
+            flow = np.zeros((h, w, 2), np.float32)
+        else:
+            flow[...] = 0
+        for (x0, y0, x1, y1), (ex0, ey0, ex1, ey1) in zip(self.rects, padded):
+            # DIS only takes continuous images, a copy of the crop is cheap next to the flow
+            part = self.engine.calc(self, np.ascontiguousarray(prev[ey0:ey1, ex0:ex1]),
+                                    np.ascontiguousarray(next[ey0:ey1, ex0:ex1]))
+            flow[y0:y1, x0:x1] = part[y0 - ey0:y1 - ey0, x0 - ex0:x1 - ex0]
+        return flow
+
+    def regionMask(self, shape):
+        '''The regions mask at compute resolution, resized once per mask and shape'''
+        key = (id(self.regions), shape[:2])
+        if self.buffers.get('region_mask_key') != key:
+            mask = np.asarray(self.regions)
+            if mask.shape[:2] != shape[:2]:
+                mask = cv2.resize(np.uint8(mask != 0), shape[1::-1], interpolation=cv2.INTER_NEAREST)
+            self.buffers['region_mask_key'] = key
+            self.buffers['region_mask'] = mask
+        return self.buffers['region_mask']
+
+    def smallSize(self, shape):
+        '''(w, h) of the compute resolution for frames of shape'''
+        h, w = shape[:2]
+        return (max(1, int(round(w * self.scale))), max(1, int(round(h * self.scale))))
+
+    def shrink(self, grayFrame):
+        '''Downscale a gray frame to the compute resolution'''
+        if self.scale == 1.0:
+            return grayFrame
+        size = self.smallSize(grayFrame.shape)
+        return cv2.resize(grayFrame, size, dst=self.buffer('small%d' % self.parity, size[::-1]),
+                          interpolation=cv2.INTER_AREA)
+
+    def expand(self, flow, shape):
+        '''Upsample flow computed by shrink() to full size, rescaling the vectors too'''
+        if self.scale == 1.0:
+            return flow
+        h, w = shape[:2]
+        flow = cv2.resize(flow, (w, h), dst=self.buffer('flow', (h, w, 2), np.float32),
+                          interpolation=cv2.INTER_LINEAR)
+        flow *= 1.0 / self.scale
+        return flow
+
     def makeResult(self, grayFrame, flow):
         '''Replace this for each expression'''
         return frame.copy()
 
 class DenseOpticalFlowByHSV(DenseOpticalFlow):
     def makeResult(self, grayFrame, flow):
-        mag, ang = cv2.cartToPolar(flow[...,0], flow[...,1])
-        self.hsv[...,0] = ang*180/np.pi/2
-        self. hsv[...,2] = cv2.normalize(mag, None, 0, 255, cv2.NORM_MINMAX)
-        return cv2.cvtColor(self.hsv, cv2.COLOR_HSV2BGR)
+        shape = flow.shape[:2]
+        fx = cv2.extractChannel(flow, 0, dst=self.buffer('fx', shape, np.float32))
+        fy = cv2.extractChannel(flow, 1, dst=self.buffer('fy', shape, np.float32))
+        mag, ang = cv2.cartToPolar(fx, fy, magnitude=self.buffer('mag', shape, np.float32),
+                                   angle=self.buffer('ang', shape, np.float32), angleInDegrees=True)
+        hue = cv2.convertScaleAbs(ang, dst=self.buffer('hue', shape), alpha=0.5)
+        val = cv2.normalize(mag, self.buffer('val', shape), 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        cv2.insertChannel(hue, self.hsv, 0)
+        cv2.insertChannel(val, self.hsv, 2)
+        return cv2.cvtColor(self.hsv, cv2.COLOR_HSV2BGR, dst=self.buffer('bgr', self.hsv.shape))
+
+_wheel = None
+
+def colorWheel(size=257):
+    '''BGR look-up table over flow (fx, fy) in [-2, 2] x [-2, 2], hue by direction, value saturating at 1'''
+    global _wheel
+    if _wheel is None or _wheel.shape[0] != size:
+        half = size // 2
+        v, u = np.mgrid[-half:half + 1, -half:half + 1].astype(np.float32) * (2.0 / half)
+        mag, ang = cv2.cartToPolar(u, v, angleInDegrees=True)
+        hsv = np.dstack([cv2.convertScaleAbs(ang, alpha=0.5), np.full(u.shape, 255, np.uint8),
+                         cv2.convertScaleAbs(np.minimum(mag, 1.0), alpha=255)])
+        _wheel = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    return _wheel
+
+class DenseOpticalFlowByColorWheel(DenseOpticalFlow):
+    '''HSV expression through a precomputed color wheel, one cv2.remap() gather per frame.
+
+    Brightness is flow magnitude over a magnitude scale: fixed in pixels when
+    magnitude is given, otherwise tracking the frame maximum slowly so it
+    does not flicker like a per-frame normalization.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.magnitude = kwargs.pop('magnitude', None) # pixels shown at full brightness, None to track
+        self.tracking = kwargs.pop('tracking', 0.05)   # fraction the tracked scale moves per frame
+        self.min_magnitude = 0.5 # tracked scale floor, keeps noise dark on static scenes
+        DenseOpticalFlow.__init__(self, *args, **kwargs)
+        self.level = None
+
+    def magnitudeScale(self, flow):
+        if self.magnitude:
+            return self.magnitude
+        sample = flow[::8, ::8]
+        peak = float(np.sqrt((sample * sample).sum(axis=2).max()))
+        self.level = peak if self.level is None else self.level + self.tracking * (peak - self.level)
+        return max(self.level, self.min_magnitude)
+
+    def makeResult(self, grayFrame, flow):
+        wheel = colorWheel()
+        half = wheel.shape[0] // 2
+        # wheel coordinates of every flow vector, the wheel spans twice the magnitude scale
+        map = cv2.addWeighted(flow, half / (2.0 * self.magnitudeScale(flow)), flow, 0.0, half,
+                              dst=self.buffer('map', flow.shape, np.float32))
+        return cv2.remap(wheel, map, None, cv2.INTER_NEAREST, dst=self.buffer('bgr', flow.shape[:2] + (3,)),
+                         borderMode=cv2.BORDER_REPLICATE)
 
 class DenseOpticalFlowByLines(DenseOpticalFlow):
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
+        DenseOpticalFlow.__init__(self, *args, **kwargs)
         self.step = 16 # configure this if you need other steps...
+        self.green = np.array((0, 255, 0), np.uint8)
+
+    def gridPoints(self, h, w):
+        '''Flat flow indices and start points of the glyph grid, cached per frame size'''
+        key = (h, w, self.step)
+        if self.buffers.get('grid_key') != key:
+            y, x = np.mgrid[self.step//2:h:self.step, self.step//2:w:self.step].reshape(2,-1)
+            self.buffers['grid_key'] = key
+            self.buffers['grid_index'] = y * w + x
+            self.buffers['grid_start'] = np.ascontiguousarray(np.vstack([x, y]).T, np.float32)
+            dots = dotPixels(np.vstack([x, y]).T, 1, (h, w))[0]
+            self.buffers['grid_dots'] = (3 * dots[:, np.newaxis] + np.arange(3)).ravel() # B, G, R bytes
+        return self.buffers['grid_index'], self.buffers['grid_start'], self.buffers['grid_dots']
 
     def makeResult(self, grayFrame, flow):
         h, w = grayFrame.shape[:2]
-        y, x = np.mgrid[self.step//2:h:self.step, self.step//2:w:self.step].reshape(2,-1)
-        fx, fy = flow[y,x].T
-        lines = np.vstack([x, y, x+fx, y+fy]).T.reshape(-1, 2, 2)
-        lines = np.int32(lines + 0.5)
-        vis = cv2.cvtColor(grayFrame, cv2.COLOR_GRAY2BGR)
-        cv2.polylines(vis, lines, 0, (0, 255, 0))
-        for (x1, y1), (x2, y2) in lines:
-            cv2.circle(vis, (x1, y1), 1, (0, 255, 0), -1)
+        index = self.gridPoints(h, w)[0]
+        motion = self.buffer('ends', (len(index), 2), np.float32)
+        motion = np.take(flow.reshape(-1, 2), index, axis=0, out=motion, mode='clip')
+        return self.drawGlyphs(grayFrame, motion)
+
+    def drawGlyphs(self, grayFrame, motion):
+        '''Draw one line per grid point from its motion (n, 2) over the gray frame'''
+        h, w = grayFrame.shape[:2]
+        index, start, dots = self.gridPoints(h, w)
+        n = len(index)
+        ends = np.add(motion, start, out=self.buffer('ends', (n, 2), np.float32))
+        ends += 0.5 # round when truncating to int32
+        lines = self.buffer('lines', (n, 2, 2), np.int32)
+        if lines is None:
+            lines = np.empty((n, 2, 2), np.int32)
+        lines[:, 0] = start
+        np.copyto(lines[:, 1], ends, casting='unsafe')
+        contours = lines
+        if self.reuse_buffers:
+            # polylines() takes a list of views without creating one array per line each frame
+            if self.buffers.get('contours_of') is not lines:
+                self.buffers['contours_of'] = lines
+                self.buffers['contours'] = list(lines)
+            contours = self.buffers['contours']
+        vis = cv2.cvtColor(grayFrame, cv2.COLOR_GRAY2BGR, dst=self.buffer('vis', (h, w, 3)))
+        cv2.polylines(vis, contours, 0, (0, 255, 0))
+        np.put(vis.reshape(-1), dots, self.green) # the glyph dots never move, their pixels are cached
         return vis
 
+class SparseOpticalFlowByLines(DenseOpticalFlowByLines):
+    '''Lines expression tracking only the glyph grid points with pyramidal Lucas-Kanade.
+
+    No dense field is computed, so .flow is None; the grid motion is left in
+    .motion and points failing the checks in .good are drawn as dots only.
+    Of the dense options only scale and reuse_buffers apply, the others
+    (engine, tiles, regions, decimate...) are rejected with a ValueError.
+    '''
+    flow_field = False
+
+    def __init__(self, scale=1.0, reuse_buffers=False, fb_threshold=1.0, **kwargs):
+        if kwargs:
+            raise ValueError('sparse_lines tracks grid points, it does not take %s' % ', '.join(sorted(kwargs)))
+        # drop points whose backward track misses the start by more than this many pixels, None to skip
+        self.fb_threshold = fb_threshold
+        DenseOpticalFlowByLines.__init__(self, scale=scale, reuse_buffers=reuse_buffers)
+        self.lk_params = dict( winSize  = (15,15),
+                               maxLevel = 3,
+                               criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.flow = None
+
+    def analyze(self, frame, render=False, **kwargs):
+        '''Grid point pairs and motion statistics (see MotionAnalytics.motionStats)'''
+        next, motion = self.compute(frame)
+        start = self.gridPoints(*next.shape[:2])[1][self.good]
+        result = dict(old=start, new=start + motion[self.good],
+                      stats=pointStats(start, start + motion[self.good], next.shape, **kwargs), image=None)
+        if render:
+            with self.stage('render'):
+                result['image'] = self.makeResult(next, motion)
+        return result
+
+    def compute(self, frame):
+        '''Advance to frame, returns its gray image and the (n, 2) motion of the grid points'''
+        with self.stage('gray'):
+            next, small = self.prepare(frame)
+            if self.prev.shape != small.shape:
+                self.prev = cv2.resize(self.prev, small.shape[::-1], interpolation=cv2.INTER_AREA)
+
+        with self.stage('flow'):
+            h, w = next.shape[:2]
+            start = self.gridPoints(h, w)[1]
+            sx, sy = small.shape[1] / float(w), small.shape[0] / float(h)
+            p0 = (start * (sx, sy)).astype(np.float32).reshape(-1, 1, 2)
+            p1, st, err = cv2.calcOpticalFlowPyrLK(self.prev, small, p0, None, **self.lk_params)
+            good = st.ravel() == 1
+            if self.fb_threshold is not None:
+                back, st, err = cv2.calcOpticalFlowPyrLK(small, self.prev, p1, None, **self.lk_params)
+                good &= (st.ravel() == 1) & (np.linalg.norm((back - p0).reshape(-1, 2), axis=1) < self.fb_threshold)
+            motion = (p1 - p0).reshape(-1, 2) / (sx, sy)
+            motion[~good] = 0
+
+        self.prev = small
+        self.parity ^= 1
+        self.motion, self.good = np.float32(motion), good
+        return next, self.motion
+
+    def makeResult(self, grayFrame, motion):
+        return self.drawGlyphs(grayFrame, motion)
+
 class DenseOpticalFlowByWarp(DenseOpticalFlow):
+    def coordinateGrid(self, h, w):
+        '''Pixel coordinates as an (x, y) map, cached per frame size'''
+        grid = self.buffers.get('grid')
+        if grid is None or grid.shape[:2] != (h, w):
+            grid = np.empty((h, w, 2), np.float32)
+            grid[:,:,0] = np.arange(w)
+            grid[:,:,1] = np.arange(h)[:,np.newaxis]
+            self.buffers['grid'] = grid
+        return grid
+
     def makeResult(self, grayFrame, flow):
         h, w = flow.shape[:2]
-        flow = -flow
-        flow[:,:,0] += np.arange(w)
-        flow[:,:,1] += np.arange(h)[:,np.newaxis]
-        return cv2.remap(grayFrame, flow, None, cv2.INTER_LINEAR)
+        map = np.negative(flow, out=self.buffer('map', flow.shape, np.float32))
+        map += self.coordinateGrid(h, w)
+        return cv2.remap(grayFrame, map, None, cv2.INTER_LINEAR,
+                         dst=self.buffer('warp', grayFrame.shape))
+
+class TrackTable:
+    '''Fixed-capacity structure-of-arrays store of point tracks.
+
+    Every track has an id, an age in frames and a ring buffer of its last
+    positions. All live tracks share the ring head, so an update is one
+    vectorized write regardless of the number of tracks.
+    '''
+    def __init__(self, capacity=100, history=32):
+        self.ids = np.zeros(capacity, np.int64)
+        self.age = np.zeros(capacity, np.int32)
+        self.alive = np.zeros(capacity, bool)
+        self.trail = np.zeros((capacity, history, 2), np.float32)
+        self.head = 0
+        self.next_id = 0
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def positions(self):
+        '''Current (x, y) of live tracks, in slot order'''
+        return self.trail[self.alive, self.head]
+
+    def add(self, points):
+        '''Start tracks at points into free slots, as many as fit'''
+        free = np.flatnonzero(~self.alive)[:len(points)]
+        n = len(free)
+        self.ids[free] = np.arange(self.next_id, self.next_id + n)
+        self.next_id += n
+        self.age[free] = 0
+        self.alive[free] = True
+        self.trail[free] = np.asarray(points, np.float32).reshape(-1, 1, 2)[:n]
+
+    def update(self, points, keep):
+        '''Advance live tracks to points, ending those where keep is False'''
+        slots = np.flatnonzero(self.alive)
+        self.head = (self.head + 1) % self.trail.shape[1]
+        self.trail[slots, self.head] = points.reshape(-1, 2)
+        self.age[slots] += 1
+        self.alive[slots[~keep]] = False
+
+    def segments(self):
+        '''Trail segments (p0, p1, live slot, steps back) from the oldest to the newest'''
+        history = self.trail.shape[1]
+        slots = np.flatnonzero(self.alive)
+        back = np.arange(history - 1, 0, -1)                  # oldest first, newest drawn on top
+        valid = self.age[slots][np.newaxis, :] >= back[:, np.newaxis] # (steps, tracks)
+        k, i = np.nonzero(valid)
+        newer = (self.head - back[k] + 1) % history
+        older = (self.head - back[k]) % history
+        s = slots[i]
+        return self.trail[s, older], self.trail[s, newer], s, back[k]
 
 class LucasKanadeOpticalFlow(IOpticalFlow):
-    def __init__(self):
+    def __init__(self, history=32, detect_interval=5, max_age=None):
         # params for ShiTomasi corner detection
         self.feature_params = dict( maxCorners = 100,
                                     qualityLevel = 0.3,
@@ -87,55 +738,127 @@ class LucasKanadeOpticalFlow(IOpticalFlow):
                                maxLevel = 2,
                                criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
 
-        # Create some random colors
+        # Track management: trail length, frames between re-detections, and frames before a track is retired
+        self.history = history
+        self.detect_interval = detect_interval
+        self.max_age = max_age
+
+        # Create some random colors, picked by track id
         self.color = np.random.randint(0,255,(100,3))
 
     def set1stFrame(self, frame):
-        self.old_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        self.p0 = cv2.goodFeaturesToTrack(self.old_gray, mask = None, **self.feature_params)
-        # Create a mask image for drawing purposes
-        self.mask = np.zeros_like(frame)
+        self.old_gray = self.toGray(frame)
+        self.tracks = TrackTable(self.feature_params['maxCorners'], self.history)
+        self.frames = 0
+        self.detect(self.old_gray)
+        self.p0 = self.tracks.positions().reshape(-1,1,2)
+
+    def toGray(self, frame):
+        '''Gray image of frame, from the shared cache if set'''
+        if self.cache is not None:
+            return self.cache.gray(frame)
+        if frame.ndim == 2:
+            return frame.copy()
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    def detect(self, gray):
+        '''Start new tracks on corners away from the existing ones'''
+        wanted = min(self.feature_params['maxCorners'], len(self.tracks.alive)) - len(self.tracks)
+        if wanted <= 0:
+            return
+        mask = np.full(gray.shape, 255, np.uint8)
+        drawDots(mask, self.tracks.positions(), self.feature_params['minDistance'], 0)
+        params = dict(self.feature_params, maxCorners=wanted)
+        points = cv2.goodFeaturesToTrack(gray, mask = mask, **params)
+        if points is not None:
+            self.tracks.add(points)
 
     def apply(self, frame):
-        frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.compute(frame)
+        with self.stage('render'):
+            return self.makeResult(frame)
+
+    def analyze(self, frame, render=False, **kwargs):
+        '''Point pairs and motion statistics (see MotionAnalytics.motionStats) without rendering unless asked'''
+        self.compute(frame)
+        result = dict(old=self.good_old.reshape(-1,2), new=self.good_new.reshape(-1,2),
+                      stats=pointStats(self.good_old, self.good_new, frame.shape, **kwargs), image=None)
+        if render:
+            with self.stage('render'):
+                result['image'] = self.makeResult(frame)
+        return result
+
+    def compute(self, frame):
+        '''Track points into frame, the kept pairs are left in good_old/good_new'''
+        with self.stage('gray'):
+            frame_gray = self.toGray(frame)
+        tracks = self.tracks
+        h, w = frame_gray.shape
 
         # calculate optical flow
-        p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, frame_gray,
-                                               self.p0, None, **self.lk_params)
+        self.good_old = self.good_new = np.zeros((0,1,2), np.float32)
+        if len(tracks):
+            p0 = tracks.positions().reshape(-1,1,2)
+            with self.stage('flow'):
+                p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, frame_gray,
+                                                       p0, None, **self.lk_params)
 
-        # Select good points
-        good_new = p1[st==1]
-        good_old = self.p0[st==1]
+            # Keep good points that stay in the frame and are not too old
+            x, y = p1.reshape(-1,2).T
+            keep = (st.ravel() == 1) & (x >= 0) & (x < w) & (y >= 0) & (y < h)
+            if self.max_age is not None:
+                keep &= tracks.age[tracks.alive] < self.max_age
+            tracks.update(p1, keep)
+            self.good_old, self.good_new = p0[keep], p1[keep] # point pairs of this frame
 
-        # draw the tracks
-        for i, (new,old) in enumerate(zip(good_new,good_old)):
-            a,b = new.ravel()
-            c,d = old.ravel()
-            self.mask = cv2.line(self.mask, (a,b), (c,d), self.color[i].tolist(), 2)
-            frame = cv2.circle(frame, (a,b), 5, self.color[i].tolist(), -1)
-        img = cv2.add(frame, self.mask)
+        self.frames += 1
+        if self.frames % self.detect_interval == 0:
+            with self.stage('detect'):
+                self.detect(frame_gray)
 
-        # Now update the previous frame and previous points
-        self.old_gray = frame_gray.copy()
-        self.p0 = good_new.reshape(-1,1,2)
+        # Now update the previous frame and current points
+        self.old_gray = frame_gray
+        self.p0 = tracks.positions().reshape(-1,1,2)
 
+    def makeResult(self, frame):
+        '''Draw the tracks over frame, trails fade out with age'''
+        tracks = self.tracks
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        p0, p1, slots, back = tracks.segments()
+        fade = 1.0 - back[:, np.newaxis] / float(self.history)
+        overlay = np.zeros_like(frame)
+        drawSegments(overlay, p0, p1, self.color[tracks.ids[slots] % len(self.color)] * fade, 2)
+        img = cv2.add(frame, overlay)
+        live = np.flatnonzero(tracks.alive)
+        drawDots(img, tracks.positions(), 5, self.color[tracks.ids[live] % len(self.color)])
         return img
 
 
-def CreateOpticalFlow(type):
-    '''Optical flow showcase factory, call by type as shown below'''
-    def dense_by_hsv():
-        return DenseOpticalFlowByHSV()
-    def dense_by_lines():
-        return DenseOpticalFlowByLines()
-    def dense_by_warp():
-        return DenseOpticalFlowByWarp()
-    def lucas_kanade():
-        return LucasKanadeOpticalFlow()
-    return {
-        'dense_hsv': dense_by_hsv,
-        'dense_lines': dense_by_lines,
-        'dense_warp': dense_by_warp,
-        'lucas_kanade': lucas_kanade
-    }.get(type, dense_by_lines)()
-    
+# type name -> class, dense types render the flow of any engine
+TYPES = {
+    'dense_hsv': DenseOpticalFlowByHSV,
+    'dense_wheel': DenseOpticalFlowByColorWheel,
+    'dense_lines': DenseOpticalFlowByLines,
+    'sparse_lines': SparseOpticalFlowByLines,
+    'dense_warp': DenseOpticalFlowByWarp,
+    'lucas_kanade': LucasKanadeOpticalFlow,
+}
+
+def registerType(name, cls):
+    '''Make an IOpticalFlow class available to CreateOpticalFlow() by name'''
+    TYPES[name] = cls
+
+def CreateOpticalFlow(type, **kwargs):
+    '''Optical flow showcase factory, call by type as listed in TYPES.
+
+    Keyword arguments go to the constructor, e.g. scale=0.25 or
+    engine='dis_fast' (see ENGINES, 'auto' to benchmark) for dense types.
+    '''
+    return TYPES.get(type, DenseOpticalFlowByLines)(**kwargs)
+
+def unwrap(of):
+    '''The flow object inside wrappers (MotionGate, QualityGovernor...) that keep theirs in .of'''
+    while not isinstance(of, (LucasKanadeOpticalFlow, DenseOpticalFlow)) and 'of' in vars(of):
+        of = vars(of)['of']
+    return of
@@ -0,0 +1,117 @@
+# Adaptive quality governor: tunes flow parameters at run time to hold a target frame rate
+
+## reference
+# - https://docs.opencv.org/3.4/dc/d6b/group__video__track.html
+
+import time
+from OpticalFlowShowcase import *
+
+# Quality ladders from best to cheapest, one step is applied at a time. They are caps on the
+# wrapped object's own settings, which stay the top step
+DENSE_LADDER = [
+    dict(scale=1.0,  levels=3, winsize=15, iterations=3),
+    dict(scale=1.0,  levels=3, winsize=13, iterations=2),
+    dict(scale=0.75, levels=3, winsize=13, iterations=2),
+    dict(scale=0.5,  levels=3, winsize=11, iterations=2),
+    dict(scale=0.5,  levels=2, winsize=9,  iterations=1),
+    dict(scale=0.35, levels=2, winsize=9,  iterations=1),
+    dict(scale=0.25, levels=2, winsize=7,  iterations=1),
+]
+
+LK_LADDER = [
+    dict(maxCorners=100, winSize=(15, 15), maxLevel=2),
+    dict(maxCorners=75,  winSize=(13, 13), maxLevel=2),
+    dict(maxCorners=50,  winSize=(11, 11), maxLevel=2),
+    dict(maxCorners=35,  winSize=(9, 9),   maxLevel=1),
+    dict(maxCorners=20,  winSize=(7, 7),   maxLevel=1),
+]
+
+def _cheaper(base, preset):
+    '''Each setting of preset, but never above the one in base'''
+    return dict((key, tuple(map(min, base[key], value)) if isinstance(value, tuple) else min(base[key], value))
+                for key, value in preset.items())
+
+def buildLadder(base, caps):
+    '''base settings followed by the distinct steps of caps applied to them'''
+    ladder = [base]
+    for preset in caps:
+        step = _cheaper(base, preset)
+        if step != ladder[-1]:
+            ladder.append(step)
+    return ladder
+
+class QualityGovernor(IOpticalFlow):
+    '''Wraps an IOpticalFlow and steps its quality up/down to fit a latency budget.
+
+    Per-frame apply() latency is smoothed with an EMA, the level steps down
+    (cheaper) when over budget and up again only when well under it. The
+    wrapped object may itself be a wrapper (e.g. MotionAccumulator), the
+    ladder is applied to the flow object inside. Its settings at wrapping
+    time are the best level and are left alone until the first step.
+    warm_start is set on dense types only when given. Unknown attributes
+    are forwarded to the wrapped object.
+    '''
+    def __init__(self, of, target_fps=None, budget=None, interval=10, warm_start=None):
+        if budget is None:
+            budget = 1.0 / (target_fps or 30.0)
+        self.of = of
+        self.budget = budget    # seconds per apply()
+        self.interval = interval # frames between decisions
+        target = self.target()
+        if isinstance(target, LucasKanadeOpticalFlow):
+            self.ladder = buildLadder(dict(maxCorners=target.feature_params['maxCorners'],
+                                           winSize=tuple(target.lk_params['winSize']),
+                                           maxLevel=target.lk_params['maxLevel']), LK_LADDER)
+        elif isinstance(target, DenseOpticalFlow):
+            params = target.farneback_params
+            self.ladder = buildLadder(dict(scale=target.scale, levels=params['levels'],
+                                           winsize=params['winsize'], iterations=params['iterations']),
+                                      DENSE_LADDER)
+            if warm_start is not None:
+                target.warm_start = warm_start
+        else:
+            self.ladder = [{}] # nothing to tune
+        self.level = 0
+        self.latency = None
+        self.frames = 0
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['of'], name)
+
+    def target(self):
+        '''The flow object the ladder tunes, looking through wrappers that keep theirs in .of'''
+        return unwrap(self.of)
+
+    def set1stFrame(self, frame):
+        self.of.set1stFrame(frame)
+
+    def apply(self, frame):
+        start = time.perf_counter()
+        result = self.of.apply(frame)
+        elapsed = time.perf_counter() - start
+
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        self.frames += 1
+        if self.frames % self.interval == 0:
+            if self.latency > 1.05 * self.budget:
+                self.setLevel(self.level + 1)
+            elif self.latency < 0.6 * self.budget:
+                self.setLevel(self.level - 1)
+        return result
+
+    def setLevel(self, level):
+        '''Apply one step of the quality ladder, 0 is the best quality'''
+        level = max(0, min(level, len(self.ladder) - 1))
+        preset = self.ladder[level]
+        if level != self.level:
+            self.latency = None # measure the new setting from scratch
+        self.level = level
+        of = self.target()
+        if isinstance(of, LucasKanadeOpticalFlow):
+            of.feature_params['maxCorners'] = preset['maxCorners']
+            of.lk_params['winSize'] = preset['winSize']
+            of.lk_params['maxLevel'] = preset['maxLevel']
+        elif isinstance(of, DenseOpticalFlow):
+            of.scale = preset['scale']
+            for key in ('levels', 'winsize', 'iterations'):
+                of.farneback_params[key] = preset[key]
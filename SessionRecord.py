@@ -0,0 +1,122 @@
+# Recorded sessions: captured frames and key events with timestamps in one append-only file, for replay
+
+## reference
+# - https://docs.python.org/3/library/struct.html
+# - https://docs.opencv.org/master/d4/da8/group__imgcodecs.html
+
+import json
+import os
+import struct
+import threading
+import time
+import queue
+import numpy as np
+import cv2
+
+MAGIC = b'OFSESSN\x00'
+HEADER_SIZE = 512 # magic + JSON, padded so events start at a fixed offset
+VERSION = 1
+EVENT = struct.Struct('<cdI') # kind, timestamp, payload size
+KEY_CODE = struct.Struct('<i')
+FRAME = b'F'
+KEY = b'K'
+
+# File layout:
+#   [HEADER_SIZE bytes] MAGIC, then JSON meta data padded with spaces
+#   [event] * n       EVENT header, then its payload:
+#                     FRAME - the frame encoded with the codec in the meta data (PNG is lossless)
+#                     KEY   - the cv2.waitKey() code as int32
+# Events are in the order they happened, a key event applies from the next frame on. A file
+# cut short by a crash is readable up to its last complete event.
+
+class SessionWriter:
+    '''Appends frames and key events of a live session, encoding frames on a thread.
+
+    frame() copies the frame, as capture buffers get reused, and queues it;
+    the queue blocks when full so no frame is lost. meta is stored in the
+    header, e.g. the options needed to replay the session.
+    '''
+    def __init__(self, path, codec='.png', meta=None, depth=64):
+        self.codec = codec
+        self.file = open(path, 'wb')
+        head = MAGIC + json.dumps(dict(meta or {}, version=VERSION, codec=codec, created=time.time())).encode('utf-8')
+        if len(head) > HEADER_SIZE:
+            raise ValueError('session meta data too long')
+        self.file.write(head.ljust(HEADER_SIZE, b' '))
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.frames = 0
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, timestamp, value = item
+            try:
+                if kind == FRAME:
+                    payload = cv2.imencode(self.codec, value)[1].tobytes()
+                else:
+                    payload = KEY_CODE.pack(value)
+                self.file.write(EVENT.pack(kind, timestamp, len(payload)) + payload)
+            except BaseException as e:
+                self.error = e
+
+    def frame(self, frame, timestamp=None):
+        self.queue.put((FRAME, time.time() if timestamp is None else timestamp, frame.copy()))
+        self.frames += 1
+
+    def key(self, key, timestamp=None):
+        self.queue.put((KEY, time.time() if timestamp is None else timestamp, key))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+class SessionReader:
+    '''Events of a session file in order; the events are indexed on open, frames decoded on demand'''
+    def __init__(self, path):
+        self.path = path
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+            if len(head) < HEADER_SIZE or not head.startswith(MAGIC):
+                raise IOError('not a session file')
+            self.meta = json.loads(head[len(MAGIC):].decode('utf-8'))
+            if self.meta['version'] > VERSION:
+                raise IOError('unsupported session version %d' % self.meta['version'])
+            self.events = [] # (kind, timestamp, payload offset, payload size)
+            offset = HEADER_SIZE
+            while offset + EVENT.size <= size:
+                f.seek(offset)
+                kind, timestamp, length = EVENT.unpack(f.read(EVENT.size))
+                if offset + EVENT.size + length > size:
+                    break # cut short while writing
+                self.events.append((kind, timestamp, offset + EVENT.size, length))
+                offset += EVENT.size + length
+        self.frames = sum(1 for e in self.events if e[0] == FRAME)
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def duration(self):
+        '''Seconds from the first to the last event'''
+        return self.events[-1][1] - self.events[0][1] if self.events else 0.0
+
+    def __iter__(self):
+        '''(kind, timestamp, frame or key code) of every event'''
+        with open(self.path, 'rb') as f:
+            for kind, timestamp, offset, length in self.events:
+                f.seek(offset)
+                payload = f.read(length)
+                if kind == FRAME:
+                    yield kind, timestamp, cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_UNCHANGED)
+                else:
+                    yield kind, timestamp, KEY_CODE.unpack(payload)[0]
@@ -0,0 +1,45 @@
+# Frame slots in shared memory for passing images between processes without pickling
+
+## reference
+# - https://docs.python.org/3/library/multiprocessing.shared_memory.html
+
+from multiprocessing import shared_memory
+import numpy as np
+
+class SharedFrameRing:
+    '''A fixed number of equally shaped frame slots in one shared memory block.
+
+    The creating process owns the block and must unlink() it, other
+    processes attach() by spec() and only close() it. Create rings in the
+    parent so the block outlives its workers.
+    '''
+    def __init__(self, shape, dtype=np.uint8, slots=3, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        size = int(np.prod(self.shape)) * self.dtype.itemsize * slots
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray((slots,) + self.shape, self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, spec):
+        '''Attach to a ring created in another process'''
+        name, shape, dtype, slots = spec
+        return cls(shape, dtype, slots, name)
+
+    def spec(self):
+        '''Picklable description to attach() from another process'''
+        return (self.shm.name, self.shape, self.dtype.str, self.slots)
+
+    def __getitem__(self, slot):
+        return self.array[slot]
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -0,0 +1,89 @@
+# Synthetic video sequences with known ground-truth flow, for benchmarks without a camera
+
+## reference
+# - https://docs.opencv.org/3.4/da/d54/group__imgproc__transform.html
+
+import numpy as np
+import cv2
+
+SEQUENCES = ('translate', 'rotate', 'zoom', 'sprites')
+
+def makeTexture(height, width, seed=0):
+    '''Band-limited random BGR texture that gives every method something to track'''
+    rng = np.random.RandomState(seed)
+    texture = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    fine = cv2.GaussianBlur(texture, (0, 0), 1.5)
+    coarse = cv2.GaussianBlur(texture, (0, 0), 6)
+    return cv2.addWeighted(fine, 0.5, cv2.normalize(coarse, None, 0, 255, cv2.NORM_MINMAX), 0.5, 0)
+
+def _affine(kind, t, width, height):
+    '''2x3 texture -> frame transform of frame t'''
+    cx, cy = width / 2.0, height / 2.0
+    if kind == 'translate':
+        return np.float64([[1, 0, -1.5 * t], [0, 1, -0.75 * t]])
+    if kind == 'rotate':
+        return cv2.getRotationMatrix2D((cx, cy), 0.5 * t, 1.0)
+    if kind == 'zoom':
+        return cv2.getRotationMatrix2D((cx, cy), 0.0, 1.01 ** t)
+    raise ValueError('unknown sequence ' + kind)
+
+def _compose(m2, m1inv):
+    return np.vstack([m2, [0, 0, 1]]).dot(np.vstack([m1inv, [0, 0, 1]]))[:2]
+
+def affineSequence(kind, width, height, count, seed=0):
+    '''Frames of a texture under a per-frame translation, rotation or zoom, and the exact flow between them'''
+    margin = max(width, height) // 2
+    texture = makeTexture(height + 2 * margin, width + 2 * margin, seed)
+    shift = np.float64([[1, 0, -margin], [0, 1, -margin]]) # texture origin at the frame origin
+    y, x = np.mgrid[0:height, 0:width].astype(np.float64)
+    frames, flows = [], []
+    for t in range(count):
+        m = _compose(_affine(kind, t, width, height), shift)
+        frames.append(cv2.warpAffine(texture, m, (width, height), flags=cv2.INTER_LINEAR,
+                                     borderMode=cv2.BORDER_REFLECT))
+        if t > 0:
+            step = _compose(m, cv2.invertAffineTransform(previous))
+            fx = step[0, 0] * x + step[0, 1] * y + step[0, 2] - x
+            fy = step[1, 0] * x + step[1, 1] * y + step[1, 2] - y
+            flows.append(np.dstack([fx, fy]).astype(np.float32))
+        previous = m
+    return frames, flows
+
+def _bounce(p, limit):
+    '''Position bouncing between 0 and limit'''
+    p = np.mod(p, 2 * limit)
+    return np.where(p > limit, 2 * limit - p, p)
+
+def spriteSequence(width, height, count, sprites=6, seed=0):
+    '''Textured squares moving at constant velocities over a static background.
+
+    Ground truth is the sprite velocity inside each sprite of the earlier
+    frame and zero elsewhere; later sprites are drawn on top.
+    '''
+    rng = np.random.RandomState(seed)
+    background = makeTexture(height, width, seed)
+    size = max(16, min(width, height) // 6)
+    patches = [makeTexture(size, size, seed + 1 + i) for i in range(sprites)]
+    start = rng.uniform(0, 1, (sprites, 2)) * (width - size, height - size)
+    velocity = rng.uniform(-3, 3, (sprites, 2))
+    limit = np.float64([width - size, height - size])
+    frames, flows = [], []
+    for t in range(count):
+        frame = background.copy()
+        flow = np.zeros((height, width, 2), np.float32)
+        now = np.int32(np.round(_bounce(start + velocity * t, limit)))
+        later = np.int32(np.round(_bounce(start + velocity * (t + 1), limit)))
+        for i, patch in enumerate(patches):
+            x, y = now[i]
+            frame[y:y + size, x:x + size] = patch
+            flow[y:y + size, x:x + size] = later[i] - now[i]
+        frames.append(frame)
+        if t < count - 1:
+            flows.append(flow)
+    return frames, flows
+
+def makeSequence(name, width, height, count, seed=0):
+    '''Frames and ground-truth flows, flows[i] maps frame i to frame i + 1'''
+    if name == 'sprites':
+        return spriteSequence(width, height, count, seed=seed)
+    return affineSequence(name, width, height, count, seed)
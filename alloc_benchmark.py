@@ -0,0 +1,78 @@
+# Allocation benchmark: memory allocated per apply() in steady state, with and without reuse_buffers
+
+## reference
+# - https://docs.python.org/3/library/tracemalloc.html
+
+import argparse
+import sys
+import time
+import tracemalloc
+import numpy as np
+import cv2
+from OpticalFlowShowcase import *
+
+def makeFrames(width, height, count):
+    '''Smoothly panning random texture, generated before measuring'''
+    rng = np.random.RandomState(0)
+    texture = rng.randint(0, 255, (height + count, width + 2 * count, 3)).astype(np.uint8)
+    texture = cv2.GaussianBlur(texture, (0, 0), 3)
+    return [np.ascontiguousarray(texture[i:i + height, 2 * i:2 * i + width]) for i in range(count)]
+
+def measure(type, frames, warmup, **kwargs):
+    '''Returns (worst transient bytes per frame, bytes retained over the run, ms per frame)'''
+    of = CreateOpticalFlow(type, **kwargs)
+    of.set1stFrame(frames[0])
+    for frame in frames[1:warmup + 1]:
+        of.apply(frame)
+
+    start = time.perf_counter()
+    for frame in frames[warmup + 1:]:
+        of.apply(frame)
+    ms = 1000.0 * (time.perf_counter() - start) / (len(frames) - warmup - 1)
+
+    # NumPy and OpenCV's Python bindings allocate array data through tracemalloc-visible
+    # allocators, so every output image or temporary shows up here
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    worst = 0
+    for frame in frames[warmup + 1:]:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        of.apply(frame)
+        worst = max(worst, tracemalloc.get_traced_memory()[1] - current)
+    retained = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return worst, retained, ms
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure per-frame allocations of the dense optical flow types.')
+    parser.add_argument('--size', default='640x480', help='frame size WxH (default: 640x480)')
+    parser.add_argument('--frames', type=int, default=30, help='frames to measure (default: 30)')
+    parser.add_argument('--scale', type=float, default=1.0, help='compute scale (default: 1.0)')
+    parser.add_argument('--max-bytes', type=int, default=4096,
+                        help='exit with an error when reuse mode allocates more bytes per frame (default: 4096)')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    warmup = 3
+    frames = makeFrames(width, height, args.frames + warmup + 1)
+    frame_bytes = frames[0].nbytes
+
+    failed = []
+    print('%-12s %-8s %16s %14s %10s' % ('type', 'buffers', 'alloc/frame', 'retained', 'ms/frame'))
+    for type in ('dense_hsv', 'dense_lines', 'dense_warp'):
+        for reuse in (False, True):
+            worst, retained, ms = measure(type, frames, warmup, scale=args.scale, reuse_buffers=reuse)
+            print('%-12s %-8s %10d bytes %8d bytes %10.2f' % (type, 'reuse' if reuse else 'alloc',
+                                                             worst, retained, ms))
+            if reuse and max(worst, retained) > args.max_bytes:
+                failed.append(type)
+    print('(one %dx%d BGR frame is %d bytes; OpenCV-internal scratch memory is not counted)' % (
+        width, height, frame_bytes))
+    if failed:
+        print('reuse_buffers allocates more than %d bytes per frame: %s' % (args.max_bytes, ', '.join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+# Headless batch runner: video file in, rendered flow video and/or raw flow out
+
+## reference
+# - http://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials/py_gui/py_video_display/py_video_display.html
+# - https://docs.python.org/3/library/queue.html
+
+import argparse
+import json
+import multiprocessing as mp
+import threading
+import time
+import traceback
+import queue
+import numpy as np
+import cv2
+from OpticalFlowShowcase import *
+from FlowRecord import FlowWriter
+from SharedFrames import SharedFrameRing
+
+_END = object() # end of stream marker passed down the queues
+RING_SLOTS = 4  # shared memory slots per chunk worker, whatever the chunk size
+
+class Pipeline:
+    '''Decode -> apply() -> encode, each stage on its own thread joined by bounded queues.
+
+    OpenCV releases the GIL inside decode, flow and encode calls, so the
+    three stages overlap on different cores. Queue depth bounds memory.
+    '''
+    def __init__(self, of, depth=8, render=True, analyze=False, flow=True):
+        self.of = of
+        self.depth = depth
+        self.render = render   # produce display images
+        self.analyze = analyze # produce motion statistics through of.analyze()
+        self.flow = flow       # hand a copy of of.flow to the sink
+        self.stop = threading.Event()
+        self.error = None
+        self.frames = 0
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _guard(self, stage, *args):
+        try:
+            stage(*args)
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+
+    def _decode(self, vc, flip, q_out):
+        while True:
+            rval, frame = vc.read()
+            if not rval:
+                break
+            if flip:
+                frame = cv2.flip(frame, 1)
+            if not self._put(q_out, frame):
+                return
+        self._put(q_out, _END)
+
+    def _compute(self, q_in, q_out):
+        frame = self._get(q_in)
+        if frame is _END:
+            self._put(q_out, _END)
+            return
+        self.of.set1stFrame(frame)
+        while True:
+            frame = self._get(q_in)
+            if frame is _END:
+                break
+            img, stats = _process(self.of, frame, self.render, self.analyze)
+            if img is not None and getattr(self.of, 'reuse_buffers', False):
+                img = img.copy() # overwritten by the next apply() while the sink still has it
+            flow = getattr(self.of, 'flow', None) if self.flow else None
+            if not self._put(q_out, (img, None if flow is None else flow.copy(), stats)):
+                return
+        self._put(q_out, _END)
+
+    def _encode(self, sink, q_in):
+        while True:
+            item = self._get(q_in)
+            if item is _END:
+                break
+            sink(*item)
+            self.frames += 1
+
+    def run(self, vc, sink, flip=False):
+        '''Run until the capture is exhausted, calling sink(img, flow, stats) for each result in order'''
+        q_frames = queue.Queue(self.depth)
+        q_results = queue.Queue(self.depth)
+        threads = [threading.Thread(target=self._guard, args=(self._decode, vc, flip, q_frames)),
+                   threading.Thread(target=self._guard, args=(self._compute, q_frames, q_results)),
+                   threading.Thread(target=self._guard, args=(self._encode, sink, q_results))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self.error is not None:
+            raise self.error
+        return self.frames
+
+def _process(of, frame, render, analyze):
+    '''Image and motion statistics of one frame, each only when asked for'''
+    if analyze:
+        result = of.analyze(frame, render=render)
+        return result['image'], result['stats']
+    if render:
+        return of.apply(frame), None
+    of.compute(frame) # flow only
+    return None, None
+
+def _chunkWorker(wid, path, type, options, chunks, specs, slots, free, results, stop, render, analyze, flip):
+    '''Process main: decode and compute the given (index, start, stop) chunks, results go to shared memory'''
+    try:
+        vc = cv2.VideoCapture(path)
+        images = SharedFrameRing.attach(specs[0]) if specs[0] else None
+        flows = SharedFrameRing.attach(specs[1]) if specs[1] else None
+        slot = 0
+        for chunk, start, end in chunks:
+            # frame start - 1 is decoded again only to be the first frame of the pair
+            vc.set(cv2.CAP_PROP_POS_FRAMES, start - 1)
+            of = CreateOpticalFlow(type, **options)
+            index = start
+            rval, frame = vc.read()
+            if rval:
+                of.set1stFrame(cv2.flip(frame, 1) if flip else frame)
+            while rval and index < end:
+                rval, frame = vc.read()
+                if not rval:
+                    break
+                if flip:
+                    frame = cv2.flip(frame, 1)
+                img, stats = _process(of, frame, render, analyze)
+                while not free.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if images is not None:
+                    if img.ndim == 2:
+                        cv2.cvtColor(img, cv2.COLOR_GRAY2BGR, dst=images[slot])
+                    else:
+                        np.copyto(images[slot], img)
+                if flows is not None:
+                    np.copyto(flows[slot], of.flow)
+                results.put(('frame', wid, slot, index, stats))
+                slot = (slot + 1) % slots
+                index += 1
+            results.put(('end', wid, chunk, index))
+    except BaseException:
+        results.put(('error', wid, traceback.format_exc()))
+
+class ChunkedPool:
+    '''Offline mode: a video file split into chunks computed in parallel worker processes.
+
+    A chunk of frames [start, stop) also decodes frame start - 1, so chunks
+    overlap by one frame and every flow pair is computed exactly once.
+    Chunks go round-robin to the workers, results come back through a
+    SharedFrameRing of RING_SLOTS slots per worker, and are handed to the
+    sink in frame order. Results ahead of the sink are copied out of shared
+    memory so workers keep going; those copies take up to about
+    (processes - 1) * chunk frames of ordinary memory.
+
+    Every chunk starts from a fresh flow object. Warm start and the tracked
+    brightness of dense_wheel restart at each chunk, so those frames can
+    differ from a sequential run. Lucas-Kanade tracks and decimate's keyframe
+    schedule would restart too, so they are rejected with a ValueError.
+    '''
+    def __init__(self, type, options=None, processes=None, chunk=32, render=True, analyze=False, flow=True):
+        if issubclass(TYPES.get(type, object), LucasKanadeOpticalFlow):
+            raise ValueError('%s tracks points across frames, it cannot be split into chunks' % type)
+        if (options or {}).get('decimate', 1) > 1:
+            raise ValueError('decimate holds flow across frames, it cannot be split into chunks')
+        self.type = type
+        self.options = options or {}
+        self.processes = processes or mp.cpu_count()
+        self.chunk = chunk
+        self.render = render
+        self.analyze = analyze
+        self.flow = flow
+        self.frames = 0
+
+    def run(self, path, sink, flip=False):
+        '''Like Pipeline.run(), sink(img, flow, stats) gets views into shared memory valid during the call'''
+        vc = cv2.VideoCapture(path)
+        count = int(vc.get(cv2.CAP_PROP_FRAME_COUNT))
+        rval, frame = vc.read()
+        vc.release()
+        if not rval:
+            return 0
+        if count <= 0:
+            raise IOError('cannot tell the number of frames of ' + path)
+        h, w = frame.shape[:2]
+        chunks = [(i, start, min(start + self.chunk, count)) for i, start in enumerate(range(1, count, self.chunk))]
+        processes = max(1, min(self.processes, len(chunks)))
+
+        dense = getattr(TYPES.get(self.type, DenseOpticalFlowByLines), 'flow_field', False)
+        rings = []
+        for _ in range(processes):
+            images = SharedFrameRing((h, w, 3), np.uint8, RING_SLOTS) if self.render else None
+            flows = SharedFrameRing((h, w, 2), np.float32, RING_SLOTS) if dense and self.flow else None
+            rings.append((images, flows))
+        free = [mp.Semaphore(RING_SLOTS) for _ in range(processes)]
+        results = mp.Queue()
+        stop = mp.Event()
+        procs = []
+        for wid in range(processes):
+            specs = tuple(r.spec() if r is not None else None for r in rings[wid])
+            p = mp.Process(target=_chunkWorker, args=(wid, path, self.type, self.options, chunks[wid::processes],
+                                                      specs, RING_SLOTS, free[wid], results, stop,
+                                                      self.render, self.analyze, flip))
+            p.daemon = True
+            p.start()
+            procs.append(p)
+
+        pending = {} # frame index -> (img, flow, stats, wid holding its slot or None for copies)
+        ends = {}    # chunk -> first frame index it did not produce
+        try:
+            next = 1
+            for chunk, start, end in chunks:
+                while next < end:
+                    if next in pending:
+                        img, flow, stats, wid = pending.pop(next)
+                        sink(img, flow, stats)
+                        if wid is not None:
+                            free[wid].release()
+                        self.frames += 1
+                        next += 1
+                    elif ends.get(chunk, end) <= next:
+                        return self.frames # the video ended before its frame count
+                    else:
+                        try:
+                            message = results.get(timeout=0.5)
+                        except queue.Empty:
+                            if not any(p.is_alive() for p in procs):
+                                raise RuntimeError('chunk workers exited early')
+                            continue
+                        if message[0] == 'frame':
+                            kind, wid, slot, index, stats = message
+                            images, flows = rings[wid]
+                            img = images[slot] if images else None
+                            flow = flows[slot] if flows else None
+                            if index == next:
+                                pending[index] = (img, flow, stats, wid)
+                            else: # ahead of the sink, free the slot for the worker to go on
+                                pending[index] = (None if img is None else img.copy(),
+                                                  None if flow is None else flow.copy(), stats, None)
+                                free[wid].release()
+                        elif message[0] == 'end':
+                            ends[message[2]] = message[3]
+                        else:
+                            raise RuntimeError('chunk worker %d failed:\n%s' % (message[1], message[2]))
+            return self.frames
+        finally:
+            stop.set()
+            for p in procs:
+                p.join(timeout=5)
+                if p.is_alive():
+                    p.terminate()
+            for ring in (r for pair in rings for r in pair if r is not None):
+                ring.close()
+                ring.unlink()
+
+class ResultSink:
+    '''Writes rendered images to a video file, raw flow fields to a flow record and motion stats as JSON lines'''
+    def __init__(self, video_path=None, flow_path=None, fps=30.0, fourcc='mp4v', stats_path=None,
+                 flow_dtype='int16', flow_grid=1):
+        self.video_path = video_path
+        self.stats_file = open(stats_path, 'w') if stats_path else None
+        self.index = 0
+        self.fps = fps
+        self.fourcc = fourcc
+        self.writer = None
+        # Flow frames go to a FlowRecord file, read them back with FlowRecord.FlowReader
+        self.flow_path = flow_path
+        self.flow_dtype = flow_dtype
+        self.flow_grid = flow_grid
+        self.flow_writer = None
+
+    def __call__(self, img, flow, stats=None):
+        self.index += 1
+        if self.video_path and img is not None:
+            if img.ndim == 2:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            if self.writer is None:
+                h, w = img.shape[:2]
+                self.writer = cv2.VideoWriter(self.video_path, cv2.VideoWriter_fourcc(*self.fourcc),
+                                              self.fps, (w, h))
+                if not self.writer.isOpened():
+                    raise IOError('Cannot open video writer for ' + self.video_path)
+            self.writer.write(img)
+        if self.flow_path and flow is not None:
+            if self.flow_writer is None:
+                self.flow_writer = FlowWriter(self.flow_path, flow.shape, self.flow_dtype, self.flow_grid)
+            self.flow_writer.write(flow, (self.index - 1) / self.fps) # video time of the frame
+        if self.stats_file is not None and stats is not None:
+            stats = dict((k, v.tolist() if isinstance(v, np.ndarray) else v) for k, v in stats.items())
+            stats['frame'] = self.index
+            self.stats_file.write(json.dumps(stats) + '\n')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+        if self.flow_writer is not None:
+            self.flow_writer.close()
+        if self.stats_file is not None:
+            self.stats_file.close()
+
+def flowOptions(args):
+    '''CreateOpticalFlow keyword arguments from the common command line options'''
+    options = {}
+    if args.scale != 1.0:
+        options['scale'] = args.scale
+    if getattr(args, 'tiles', None):
+        options['tiles'] = tuple(int(v) for v in args.tiles.lower().split('x'))
+    if getattr(args, 'regions', None):
+        options['regions'] = args.regions
+        if args.regions != 'motion':
+            options['regions'] = cv2.imread(args.regions, cv2.IMREAD_GRAYSCALE)
+            if options['regions'] is None:
+                raise IOError('cannot read region mask ' + args.regions)
+    if getattr(args, 'decimate', 1) > 1:
+        options['decimate'] = args.decimate
+        if args.max_error:
+            options['max_error'] = args.max_error
+    if getattr(args, 'engine', None):
+        # benchmark once here, not in every worker
+        options['engine'] = selectEngine() if args.engine == 'auto' else args.engine
+        if args.engine == 'auto':
+            print('Selected flow engine: ' + options['engine'])
+    return options
+
+def main():
+    parser = argparse.ArgumentParser(description='Run an optical flow showcase over a video file without display.')
+    parser.add_argument('input', help='input video file')
+    parser.add_argument('-t', '--type', default='dense_hsv',
+                        help='dense_hsv, dense_lines, dense_warp or lucas_kanade (default: dense_hsv)')
+    parser.add_argument('-o', '--output', help='rendered output video file')
+    parser.add_argument('--flow', help='raw flow output (flow record file, dense types only)')
+    parser.add_argument('--flow-dtype', default='int16', choices=('int16', 'float16'),
+                        help='storage type of the raw flow (default: int16)')
+    parser.add_argument('--flow-grid', type=int, default=1,
+                        help='store the raw flow this many times coarser (default: 1)')
+    parser.add_argument('--stats', help='motion statistics output, one JSON line per frame')
+    parser.add_argument('--fourcc', default='mp4v', help='output video codec (default: mp4v)')
+    parser.add_argument('--depth', type=int, default=8, help='queue depth between stages (default: 8)')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='split the video into chunks computed by this many processes (0: CPU count), '
+                             'not with lucas_kanade or --decimate')
+    parser.add_argument('--chunk', type=int, default=32,
+                        help='frames per chunk with --processes, the unit of work of a process (default: 32)')
+    parser.add_argument('--flip', action='store_true', help='flip image horizontally')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='compute dense flow at this fraction of the frame size (default: 1.0)')
+    parser.add_argument('--tiles', help='compute dense flow on RxC tiles in parallel, e.g. 2x4')
+    parser.add_argument('--engine', help='dense flow engine: %s or auto (default: farneback)' % ', '.join(ENGINES))
+    parser.add_argument('--regions', metavar='MOTION_OR_MASK',
+                        help="compute dense flow only around moving areas ('motion') or where a mask image "
+                             "is nonzero, zero elsewhere")
+    parser.add_argument('--decimate', type=int, default=1,
+                        help='compute dense flow every N frames, extrapolate in between (default: 1)')
+    parser.add_argument('--max-error', type=float,
+                        help='with --decimate, adapt the interval to keep extrapolation within this many pixels')
+    args = parser.parse_args()
+
+    if not args.output and not args.flow and not args.stats:
+        parser.error('nothing to write, give --output, --flow and/or --stats')
+
+    vc = cv2.VideoCapture(args.input)
+    if not vc.isOpened():
+        parser.error('cannot open ' + args.input)
+    fps = vc.get(cv2.CAP_PROP_FPS) or 30.0
+
+    if args.processes is not None:
+        vc.release() # the workers decode on their own
+        pipeline = ChunkedPool(args.type, flowOptions(args), args.processes, args.chunk,
+                               render=bool(args.output), analyze=bool(args.stats), flow=bool(args.flow))
+        source = args.input
+    else:
+        pipeline = Pipeline(CreateOpticalFlow(args.type, **flowOptions(args)), args.depth,
+                            render=bool(args.output), analyze=bool(args.stats), flow=bool(args.flow))
+        source = vc
+    sink = ResultSink(args.output, args.flow, fps, args.fourcc, args.stats, args.flow_dtype, args.flow_grid)
+    start = time.time()
+    try:
+        frames = pipeline.run(source, sink, args.flip)
+    finally:
+        sink.close()
+        vc.release()
+    elapsed = time.time() - start
+    print('Processed %d frames in %.2f s (%.1f fps)' % (frames, elapsed, frames / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
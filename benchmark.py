@@ -0,0 +1,349 @@
+# Benchmark suite: speed and accuracy of every optical flow type on synthetic ground truth
+
+## reference
+# - https://vision.middlebury.edu/flow/ (end-point error)
+# - https://docs.python.org/3/library/tracemalloc.html
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import cv2
+from OpticalFlowShowcase import *
+from MotionAccumulator import MotionAccumulator
+from SyntheticSequences import SEQUENCES, makeSequence, spriteSequence
+
+# CreateOpticalFlow keyword arguments per preset, dense types only (see takesPresets)
+PRESETS = {
+    'default': {},
+    'scale_0.5': dict(scale=0.5),
+    'scale_0.25': dict(scale=0.25),
+    'reuse_buffers': dict(reuse_buffers=True),
+    'tiles_2x2': dict(tiles=(2, 2)),
+    'dis_ultrafast': dict(engine='dis_ultrafast'),
+    'dis_fast': dict(engine='dis_fast'),
+    'dis_medium': dict(engine='dis_medium'),
+    'pyrlk_grid': dict(engine='pyrlk_grid'),
+    'decimate_4': dict(decimate=4),
+}
+
+BORDER = 16 # pixels excluded from end-point error, flow is undefined where content enters the frame
+
+def endPointError(of, gt):
+    '''Mean end-point error of the last apply() against the ground-truth flow'''
+    if isinstance(of, LucasKanadeOpticalFlow):
+        old, new = of.good_old.reshape(-1, 2), of.good_new.reshape(-1, 2)
+        h, w = gt.shape[:2]
+        x, y = np.int32(old[:, 0] + 0.5), np.int32(old[:, 1] + 0.5)
+        inside = (x >= BORDER) & (x < w - BORDER) & (y >= BORDER) & (y < h - BORDER)
+        if not inside.any():
+            return None
+        return float(np.linalg.norm(new[inside] - old[inside] - gt[y[inside], x[inside]], axis=1).mean())
+    if of.flow is None: # sparse lines, motion of the grid points only
+        h, w = gt.shape[:2]
+        index, start = of.gridPoints(h, w)[:2]
+        x, y = start.T
+        inside = (x >= BORDER) & (x < w - BORDER) & (y >= BORDER) & (y < h - BORDER)
+        return float(np.linalg.norm(of.motion - gt.reshape(-1, 2)[index], axis=1)[inside].mean())
+    error = np.linalg.norm(of.flow - gt, axis=2)
+    return float(error[BORDER:-BORDER, BORDER:-BORDER].mean())
+
+def takesPresets(type):
+    '''Whether a registered type is a dense flow type, which every preset applies to'''
+    cls = TYPES.get(type)
+    return cls is not None and issubclass(cls, DenseOpticalFlow) and cls.flow_field
+
+def run(type, preset, frames, flows):
+    '''Time every apply(), then measure peak memory in a second pass'''
+    of = CreateOpticalFlow(type, **PRESETS[preset])
+    of.set1stFrame(frames[0])
+    latencies, errors = [], []
+    for frame, gt in zip(frames[1:], flows):
+        start = time.perf_counter()
+        of.apply(frame)
+        latencies.append(time.perf_counter() - start)
+        error = endPointError(of, gt)
+        if error is not None:
+            errors.append(error)
+
+    of = CreateOpticalFlow(type, **PRESETS[preset])
+    tracemalloc.start()
+    of.set1stFrame(frames[0])
+    for frame in frames[1:]:
+        of.apply(frame)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000.0
+    return dict(fps=float(1000.0 / latencies.mean()),
+                p50_ms=float(np.percentile(latencies, 50)),
+                p99_ms=float(np.percentile(latencies, 99)),
+                peak_bytes=int(peak),
+                epe=float(np.mean(errors)) if errors else None)
+
+def resultKey(result):
+    return (result['sequence'], result['size'], result['type'], result['preset'])
+
+def compare(results, baseline, tolerance):
+    '''Print changes against a baseline, returns the number of regressions'''
+    base = dict((resultKey(r), r) for r in baseline['results'])
+    regressions = 0
+    print('\n%-44s %10s %10s %10s %10s' % ('vs baseline', 'fps', 'base fps', 'epe', 'base epe'))
+    for r in results:
+        b = base.get(resultKey(r))
+        if b is None:
+            continue
+        slower = r['fps'] < b['fps'] * (1.0 - tolerance)
+        worse = r['epe'] is not None and b['epe'] is not None and r['epe'] > b['epe'] * (1.0 + tolerance) + 0.01
+        flag = ' SLOWER' * slower + ' LESS ACCURATE' * worse
+        regressions += slower or worse
+        print('%-44s %10.1f %10.1f %10s %10s%s' % ('/'.join(resultKey(r)), r['fps'], b['fps'],
+                                                  '%.3f' % r['epe'] if r['epe'] is not None else '-',
+                                                  '%.3f' % b['epe'] if b['epe'] is not None else '-', flag))
+    return regressions
+
+def tiledCheck(sizes, grids, repeat=5):
+    '''Speed and agreement of calcFlowTiled() against one calcOpticalFlowFarneback() call'''
+    params = DenseOpticalFlow().farneback_params
+    print('%-10s %-6s %10s %10s %8s %12s %12s' % ('size', 'tiles', 'single ms', 'tiled ms', 'speedup',
+                                                  'mean diff', 'max diff'))
+    for size in sizes:
+        width, height = (int(v) for v in size.lower().split('x'))
+        frames, flows = makeSequence('rotate', width, height, 2)
+        prev, next = (cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) for f in frames)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            single = cv2.calcOpticalFlowFarneback(prev, next, None, **params)
+        single_ms = 1000.0 * (time.perf_counter() - start) / repeat
+        for grid in grids:
+            tiles = tuple(int(v) for v in grid.lower().split('x'))
+            calcFlowTiled(prev, next, None, params, tiles) # warm up the pool
+            start = time.perf_counter()
+            for _ in range(repeat):
+                tiled = calcFlowTiled(prev, next, None, params, tiles)
+            tiled_ms = 1000.0 * (time.perf_counter() - start) / repeat
+            diff = np.linalg.norm(tiled - single, axis=2)
+            print('%-10s %-6s %10.1f %10.1f %7.2fx %12.2e %12.2e' % (size, grid, single_ms, tiled_ms,
+                                                                    single_ms / tiled_ms, diff.mean(), diff.max()))
+
+def linesCheck(sizes, frames, sequences=('translate', 'rotate', 'sprites')):
+    '''Speed of dense Farneback lines against sparse grid LK lines, and how well their glyph vectors agree'''
+    print('%-10s %-10s %-16s %8s %10s %10s %10s' % ('sequence', 'size', 'variant', 'ms', 'grid epe',
+                                                    'vs dense', 'within 1px'))
+    variants = [('dense', 'dense_lines', {}), ('sparse', 'sparse_lines', {}),
+                ('sparse_no_fb', 'sparse_lines', dict(fb_threshold=None))]
+    for size in sizes:
+        width, height = (int(v) for v in size.lower().split('x'))
+        for sequence in sequences:
+            seq_frames, flows = makeSequence(sequence, width, height, frames)
+            motions = {}
+            for name, type, options in variants:
+                of = CreateOpticalFlow(type, **options)
+                of.set1stFrame(seq_frames[0])
+                index = of.gridPoints(height, width)[0]
+                elapsed, motions[name], truth = 0.0, [], []
+                for frame, gt in zip(seq_frames[1:], flows):
+                    start = time.perf_counter()
+                    of.apply(frame)
+                    elapsed += time.perf_counter() - start
+                    motion = of.motion if of.flow is None else of.flow.reshape(-1, 2)[index]
+                    motions[name].append(motion.copy())
+                    truth.append(gt.reshape(-1, 2)[index])
+                motion, truth = np.vstack(motions[name]), np.vstack(truth)
+                diff = np.linalg.norm(motion - np.vstack(motions['dense']), axis=1)
+                print('%-10s %-10s %-16s %8.2f %10.3f %10.3f %9.1f%%' % (
+                    sequence, size, name, 1000.0 * elapsed / (len(seq_frames) - 1),
+                    np.linalg.norm(motion - truth, axis=1).mean(), diff.mean(), 100.0 * (diff < 1.0).mean()))
+
+def wheelCheck(sizes, frames, sequences=('rotate', 'sprites'), repeat=10):
+    '''Render time of the HSV path against the color wheel LUT, their difference and brightness flicker'''
+    print('%-10s %-10s %-14s %8s %10s %10s' % ('sequence', 'size', 'renderer', 'ms', 'diff', 'flicker'))
+    for size in sizes:
+        width, height = (int(v) for v in size.lower().split('x'))
+        for sequence in sequences:
+            seq_frames, _ = makeSequence(sequence, width, height, frames)
+            of = DenseOpticalFlow(reuse_buffers=True)
+            of.set1stFrame(seq_frames[0])
+            computed = []
+            for frame in seq_frames[1:]:
+                next, flow = of.compute(frame)
+                computed.append((next.copy(), flow.copy()))
+            reference = None
+            for name, type, options in [('hsv', 'dense_hsv', {}), ('wheel_tracked', 'dense_wheel', {}),
+                                        ('wheel_frame', 'dense_wheel', {})]:
+                of = CreateOpticalFlow(type, reuse_buffers=True, **options)
+                of.set1stFrame(seq_frames[0])
+                images, elapsed = [], 0.0
+                for next, flow in computed:
+                    if name == 'wheel_frame': # same scale as the HSV path, to compare images
+                        of.magnitude = float(np.linalg.norm(flow, axis=2).max())
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        img = of.makeResult(next, flow)
+                    elapsed += time.perf_counter() - start
+                    images.append(img.copy())
+                if reference is None:
+                    reference = images
+                diff = np.mean([np.abs(a.astype(np.int16) - b).mean() for a, b in zip(images, reference)])
+                brightness = [img.max(axis=2).mean() for img in images]
+                print('%-10s %-10s %-14s %8.3f %10.2f %10.2f' % (sequence, size, name,
+                                                               1000.0 * elapsed / repeat / len(computed),
+                                                               diff, np.std(np.diff(brightness))))
+
+def decimateCheck(sizes, frames, sequences=SEQUENCES, schedules=('1', '2', '4', '8', '8:0.2')):
+    '''Speed and end-point error against full computation of flow decimated every N frames (N:max_error adapts)'''
+    print('%-10s %-10s %-8s %8s %10s %10s %10s' % ('sequence', 'size', 'schedule', 'ms', 'mean epe', 'max epe',
+                                                  'gt epe'))
+    for size in sizes:
+        width, height = (int(v) for v in size.lower().split('x'))
+        for sequence in sequences:
+            seq_frames, flows = makeSequence(sequence, width, height, frames)
+            full = []
+            for schedule in schedules:
+                decimate, _, max_error = schedule.partition(':')
+                of = DenseOpticalFlow(decimate=int(decimate), max_error=float(max_error) if max_error else None)
+                of.set1stFrame(seq_frames[0])
+                elapsed, errors, truth = 0.0, [], []
+                for i, (frame, gt) in enumerate(zip(seq_frames[1:], flows)):
+                    start = time.perf_counter()
+                    of.compute(frame)
+                    elapsed += time.perf_counter() - start
+                    if len(full) <= i:
+                        full.append(of.flow.copy()) # the first schedule should be '1'
+                    errors.append(np.linalg.norm(of.flow - full[i], axis=2)[BORDER:-BORDER, BORDER:-BORDER].mean())
+                    truth.append(np.linalg.norm(of.flow - gt, axis=2)[BORDER:-BORDER, BORDER:-BORDER].mean())
+                print('%-10s %-10s %-8s %8.2f %10.3f %10.3f %10.3f' % (sequence, size, schedule,
+                                                                   1000.0 * elapsed / len(errors), np.mean(errors),
+                                                                   np.max(errors), np.mean(truth)))
+
+def regionsCheck(sizes, frames, sprites=(1, 2, 4, 8)):
+    '''Speed and error of flow computed on active regions only, against the whole frame, as moving area grows'''
+    print('%-10s %-8s %-8s %8s %8s %10s %10s' % ('size', 'sprites', 'regions', 'ms', 'active', 'full epe',
+                                              'gt epe'))
+    for size in sizes:
+        width, height = (int(v) for v in size.lower().split('x'))
+        for count in sprites:
+            seq_frames, flows = spriteSequence(width, height, frames, sprites=count)
+            full = []
+            for regions in (None, 'motion'):
+                of = DenseOpticalFlow(regions=regions)
+                of.set1stFrame(seq_frames[0])
+                elapsed, active, errors, truth = 0.0, [], [], []
+                for i, (frame, gt) in enumerate(zip(seq_frames[1:], flows)):
+                    start = time.perf_counter()
+                    of.compute(frame)
+                    elapsed += time.perf_counter() - start
+                    if regions is None:
+                        full.append(of.flow.copy())
+                    active.append(of.active)
+                    errors.append(np.linalg.norm(of.flow - full[i], axis=2)[BORDER:-BORDER, BORDER:-BORDER].mean())
+                    truth.append(np.linalg.norm(of.flow - gt, axis=2)[BORDER:-BORDER, BORDER:-BORDER].mean())
+                print('%-10s %-8d %-8s %8.2f %8.2f %10.3f %10.3f' % (size, count, regions or 'full',
+                                                                  1000.0 * elapsed / len(errors), np.mean(active),
+                                                                  np.mean(errors), np.mean(truth)))
+
+def accumulateCheck(sizes, frames, windows=(8, 32, 128, 512)):
+    '''Update time and memory of the sliding window accumulator, which should not grow with the window'''
+    print('%-10s %-8s %10s %10s %12s' % ('size', 'window', 'update ms', 'query ms', 'memory KiB'))
+    for size in sizes:
+        width, height = (int(v) for v in size.lower().split('x'))
+        seq_frames, flows = makeSequence('sprites', width, height, frames)
+        for window in windows:
+            acc = MotionAccumulator(DenseOpticalFlow(), window)
+            acc.reset((height, width))
+            start = time.perf_counter()
+            for i in range(max(2 * window, 100)):
+                acc.add(flows[i % len(flows)])
+            update = (time.perf_counter() - start) / max(2 * window, 100)
+            start = time.perf_counter()
+            for _ in range(100):
+                acc.energy(mean=True)
+                acc.region(0, 0, width // 2, height // 2)
+            query = (time.perf_counter() - start) / 100
+            memory = acc.ring_flow.nbytes + acc.ring_energy.nbytes + acc.sum_flow.nbytes + acc.sum_energy.nbytes
+            print('%-10s %-8d %10.3f %10.3f %12d' % (size, window, 1000.0 * update, 1000.0 * query, memory // 1024))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every optical flow type on synthetic sequences with known flow.')
+    parser.add_argument('--sizes', default='320x240,640x480', help='comma separated WxH (default: 320x240,640x480)')
+    parser.add_argument('--frames', type=int, default=20, help='frames per sequence (default: 20)')
+    parser.add_argument('--sequences', default=','.join(SEQUENCES), help='comma separated, default: all')
+    parser.add_argument('--types', default=','.join(TYPES),
+                        help='comma separated, default: all registered (%s)' % ', '.join(TYPES))
+    parser.add_argument('--presets', default=','.join(PRESETS), help='comma separated, default: all')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative fps drop / error increase (default: 0.1)')
+    parser.add_argument('--tiled', metavar='GRIDS',
+                        help='only compare tiled against single-call flow for these RxC grids, e.g. 2x2,2x4,4x4')
+    parser.add_argument('--lines', action='store_true',
+                        help='only compare dense and sparse grid lines: speed and vector agreement')
+    parser.add_argument('--wheel', action='store_true',
+                        help='only compare the HSV render path with the color wheel LUT')
+    parser.add_argument('--decimate', metavar='SCHEDULES',
+                        help='only compare decimated flow with full computation, e.g. 1,2,4,8,8:0.2 '
+                             '(N or N:max_error for the adaptive schedule, start with 1)')
+    parser.add_argument('--regions', action='store_true',
+                        help='only compare flow on active regions with the whole frame, on 1 to 8 sprites')
+    parser.add_argument('--accumulate', action='store_true',
+                        help='only measure the sliding window motion accumulator for windows of 8 to 512 frames')
+    args = parser.parse_args()
+
+    if args.accumulate:
+        accumulateCheck(args.sizes.split(','), args.frames)
+        return
+
+    if args.regions:
+        regionsCheck(args.sizes.split(','), args.frames)
+        return
+
+    if args.decimate:
+        decimateCheck(args.sizes.split(','), args.frames, args.sequences.split(','), args.decimate.split(','))
+        return
+    if args.wheel:
+        wheelCheck(args.sizes.split(','), args.frames)
+        return
+    if args.lines:
+        linesCheck(args.sizes.split(','), args.frames)
+        return
+    if args.tiled:
+        tiledCheck(args.sizes.split(','), args.tiled.split(','))
+        return
+
+    results = []
+    print('%-10s %-10s %-13s %-14s %8s %8s %8s %10s %8s' % ('sequence', 'size', 'type', 'preset',
+                                                           'fps', 'p50 ms', 'p99 ms', 'peak MB', 'epe'))
+    for size in args.sizes.split(','):
+        width, height = (int(v) for v in size.lower().split('x'))
+        for sequence in args.sequences.split(','):
+            frames, flows = makeSequence(sequence, width, height, args.frames)
+            for type in args.types.split(','):
+                for preset in args.presets.split(','):
+                    if preset != 'default' and not takesPresets(type):
+                        continue
+                    r = run(type, preset, frames, flows)
+                    r.update(sequence=sequence, size=size, type=type, preset=preset)
+                    results.append(r)
+                    print('%-10s %-10s %-13s %-14s %8.1f %8.2f %8.2f %10.1f %8s' % (
+                        sequence, size, type, preset, r['fps'], r['p50_ms'], r['p99_ms'],
+                        r['peak_bytes'] / 1e6, '%.3f' % r['epe'] if r['epe'] is not None else '-'))
+
+    report = dict(meta=dict(opencv=cv2.__version__, numpy=np.__version__, python=platform.python_version(),
+                            machine=platform.machine(), processor=platform.processor(),
+                            frames=args.frames, time=time.strftime('%Y-%m-%dT%H:%M:%S')),
+                  results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,66 +5,137 @@
 # - http://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials/py_gui/py_video_display/py_video_display.html
 
 from __future__ import print_function
+import argparse
+import time
 import cv2
 from OpticalFlowShowcase import *
+from FlowMetrics import StageMetrics, drawOverlay
+from FrameCapture import BACKENDS, ThreadedCapture, openCapture
+from FrameCache import FrameCache
+from MotionGate import MotionGate
+from MotionAccumulator import MotionAccumulator
+from QualityGovernor import QualityGovernor
+from FlowRecord import FlowWriter
+from SessionRecord import SessionWriter
 
 usage_text = '''
 Hit followings to switch to:
 1 - Dense optical flow by HSV color image (default);
 2 - Dense optical flow by lines;
 3 - Dense optical flow by warped image;
-4 - Lucas-Kanade method.
+4 - Lucas-Kanade method;
+5 - Motion heatmap over the last frames (see --window).
 
 Hit 's' to save image.
 
 Hit 'f' to flip image horizontally.
 
+Hit 'm' to show/hide per-stage timings.
+
 Hit ESC to exit.
 '''
 
-def main():
-    ## private routines
-    def change(key, prevFrame):
-        message, type = {
-            ord('1'): ('==> Dense_by_hsv', 'dense_hsv'),
-            ord('2'): ('==> Dense_by_lines', 'dense_lines'),
-            ord('3'): ('==> Dense_by_warp', 'dense_warp'),
-            ord('4'): ('==> Lucas-Kanade', 'lucas_kanade')
-        }.get(key, ('==> Dense_by_hsv', 'dense_hsv'))
-        print(message)
-        of = CreateOpticalFlow(type)
-        of.set1stFrame(prevFrame)
-        return of
-    
-    def capture(vc):
-        rval, frame = vc.read()
-        if rval and flipImage:
-            frame = cv2.flip(frame, 1)
-        return (rval, frame)
-        
+def change(key, prevFrame, args, engine='farneback', metrics=None, cache=None, of=None):
+    '''Optical flow object for a method key, started on prevFrame; of is the one it replaces'''
+    message, type = {
+        ord('1'): ('==> Dense_by_hsv', 'dense_hsv'),
+        ord('2'): ('==> Dense_by_lines', 'dense_lines'),
+        ord('3'): ('==> Dense_by_warp', 'dense_warp'),
+        ord('4'): ('==> Lucas-Kanade', 'lucas_kanade'),
+        ord('5'): ('==> Motion heatmap', 'dense_hsv')
+    }.get(key, ('==> Dense_by_hsv', 'dense_hsv'))
+    print(message)
+    new = CreateOpticalFlow(type, **({'engine': engine} if type.startswith('dense') else {}))
+    new.metrics = metrics
+    new.cache = cache # the frame is already preprocessed, switching recomputes nothing
+    if key == ord('5'):
+        new = MotionAccumulator(new, args.window)
+        new.metrics = metrics
+    if args.target_fps:
+        new = QualityGovernor(new, args.target_fps)
+        new.metrics = metrics
+    if args.gate:
+        printGate(of)
+        new = MotionGate(new, args.gate, args.gate / 2.0)
+        new.metrics = metrics
+    new.set1stFrame(prevFrame)
+    return new
+
+def printGate(of):
+    if isinstance(of, MotionGate):
+        print('Motion gate skipped %(skipped)d of %(frames)d frames (%(hit_rate).0f%%), saving ~%(saved_s).1f s' %
+              dict(of.stats(), hit_rate=100.0 * of.hitRate()))
+
+def main(args):
     ## main starts here
+    of = None
+    engine = args.engine
+    if engine == 'auto':
+        engine = selectEngine()
+        print('Selected flow engine: ' + engine)
     flipImage = True
-    vc = cv2.VideoCapture(0)
+    showTimings = args.overlay
+    metrics = StageMetrics()
+    cache = FrameCache()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print('Metrics on http://127.0.0.1:%d/metrics' % args.metrics_port)
+    metricsLog = open(args.metrics_log, 'a') if args.metrics_log else None
+    lastLog = time.time()
+    flowRecord = None
+    session = None
+    size = tuple(int(v) for v in args.size.lower().split('x')) if args.size else None
+    vc = openCapture(args.backend, args.source, size, args.gray)
     if not vc.isOpened():
-        exit -1
+        print('Cannot open %s capture' % args.backend)
+        return
+    # capture and flip run on their own thread, we always get the newest frame
+    cap = ThreadedCapture(vc, flipImage)
             
     cv2.namedWindow("preview")
             
     ### try to get the first frame
-    rval, frame = capture(vc)
+    rval, frame = cap.read()
     if rval:
-        of = change('1', frame)
+        cache.push(frame)
+        if args.record_session:
+            session = SessionWriter(args.record_session, args.session_codec,
+                                    dict(engine=engine, gate=args.gate, window=args.window, target_fps=args.target_fps,
+                                         size=args.size))
+            session.frame(frame)
+        of = change('1', frame, args, engine, metrics, cache)
 
     ### main work
     while rval:
-        rval, frame = capture(vc)
+        with metrics.stage('capture'):
+            rval, frame = cap.read()
+        if not rval:
+            break
+        cache.push(frame) # capture reuses its buffers, start a new cache entry
+        if session:
+            session.frame(frame)
 
         ### do it
-        img = of.apply(frame)
-        cv2.imshow("preview", img)
+        with metrics.stage('apply'):
+            img = of.apply(frame)
+        flow = getattr(of, 'flow', None) # dense types only
+        if args.record_flow and flow is not None:
+            if flowRecord is None:
+                flowRecord = FlowWriter(args.record_flow, flow.shape)
+            flowRecord.write(flow)
+        if showTimings:
+            drawOverlay(img, metrics)
+        with metrics.stage('imshow'):
+            cv2.imshow("preview", img)
+        if metricsLog and time.time() - lastLog >= 1.0:
+            metricsLog.write(metrics.jsonLine() + '\n')
+            lastLog = time.time()
 
         ### key operation
-        key = cv2.waitKey(1)
+        with metrics.stage('waitKey'):
+            key = cv2.waitKey(1)
+        if session and key != -1:
+            session.key(key)
         if key == 27:         # exit on ESC
             print('Closing...')
             break
@@ -74,15 +145,55 @@ def main():
             print("Saved raw frame as 'img_raw.png' and displayed as 'img_w_flow.png'")
         elif key == ord('f'):   # save
             flipImage = not flipImage
+            cap.flip = flipImage
             print("Flip image: " + {True:"ON", False:"OFF"}.get(flipImage))
-        elif ord('1') <= key and key <= ord('4'):
-            of = change(key, frame)
+        elif key == ord('m'):
+            showTimings = not showTimings
+        elif ord('1') <= key and key <= ord('5'):
+            of = change(key, frame, args, engine, metrics, cache, of)
 
     ## finish
-    vc.release()
+    if metricsLog:
+        metricsLog.close()
+    if flowRecord:
+        flowRecord.close()
+    if session:
+        session.close()
+        print('Recorded %d frames to %s' % (session.frames, args.record_session))
+    cap.release()
+    printGate(of)
+    print('Captured %d frames, dropped %d stale ones' % (cap.captured, cap.dropped))
     cv2.destroyWindow("preview")
 
 
+def parseArgs(argv=None, backend='opencv'):
+    parser = argparse.ArgumentParser(description='Optical flow showcase on a camera.')
+    parser.add_argument('--backend', default=backend, choices=sorted(BACKENDS),
+                        help='capture backend (default: %s)' % backend)
+    parser.add_argument('--source', help='camera index, video file/URL or synthetic sequence name')
+    parser.add_argument('--size', help='capture size WxH for cameras (default: native for OpenCV cameras, '
+                                       'else 320x240)')
+    parser.add_argument('--gray', action='store_true',
+                        help='capture gray frames (camera luma plane where available), flow needs nothing else')
+    parser.add_argument('--overlay', action='store_true', help='start with per-stage timings shown')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus/JSON metrics on this local port')
+    parser.add_argument('--metrics-log', help='append a JSON line of stage timings every second')
+    parser.add_argument('--engine', default='farneback',
+                        help='dense flow engine: %s or auto (default: farneback)' % ', '.join(ENGINES))
+    parser.add_argument('--target-fps', type=float,
+                        help='step flow quality down/up at run time to hold this frame rate')
+    parser.add_argument('--gate', type=float, metavar='THRESHOLD',
+                        help='skip flow on static scenes, resume when a block changes by more than THRESHOLD gray levels')
+    parser.add_argument('--window', type=int, default=30,
+                        help='frames the motion heatmap accumulates (default: 30)')
+    parser.add_argument('--record-flow', help='append the dense flow of every frame to this flow record file')
+    parser.add_argument('--record-session', help='save frames and keys to this file for replay_main.py')
+    parser.add_argument('--session-codec', default='.png', choices=('.png', '.jpg'),
+                        help='frame encoding of --record-session, .png is lossless (default: .png)')
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
+    args = parseArgs()
     print(usage_text)
-    main()
+    main(args)
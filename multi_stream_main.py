@@ -0,0 +1,258 @@
+# Multi-stream server: many cameras/videos through IOpticalFlow instances in a process pool
+
+## reference
+# - https://docs.python.org/3/library/multiprocessing.html
+# - https://docs.python.org/3/library/multiprocessing.shared_memory.html
+
+import argparse
+import multiprocessing as mp
+import time
+import traceback
+import queue
+import numpy as np
+import cv2
+from OpticalFlowShowcase import *
+from SharedFrames import SharedFrameRing
+from batch_main import flowOptions
+from QualityGovernor import QualityGovernor
+
+def openSource(source):
+    '''Camera index for digits, otherwise a file name or URL'''
+    return cv2.VideoCapture(int(source) if source.isdigit() else source)
+
+class _WorkerStream:
+    '''Per-stream state living in a worker process'''
+    def __init__(self, sid, source, type, options, target_fps, spec, free):
+        self.sid = sid
+        self.source = source
+        self.vc = openSource(source)
+        self.of = CreateOpticalFlow(type, **options)
+        if target_fps:
+            self.of = QualityGovernor(self.of, target_fps)
+        self.ring = SharedFrameRing.attach(spec)
+        self.free = free
+        self.slot = 0
+        self.started = False
+        self.frame = np.empty(self.ring.shape, np.uint8)
+
+def _worker(streams, type, options, target_fps, free, results, stop, loop):
+    '''Process main: round-robin over the shard of streams given to this worker.
+
+    An exception fails every stream of the shard that has not ended, with an
+    ('error', sids, traceback) message.
+    '''
+    active = []
+    ended = set()
+    try:
+        for sid, source, spec in streams:
+            active.append(_WorkerStream(sid, source, type, options, target_fps, spec, free[sid]))
+        while active and not stop.is_set():
+            for st in list(active):
+                rval, frame = st.vc.read()
+                if not rval and loop and st.vc.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                    rval, frame = st.vc.read()
+                if not rval:
+                    st.vc.release()
+                    st.ring.close()
+                    active.remove(st)
+                    ended.add(st.sid)
+                    results.put(('eof', st.sid))
+                    continue
+                h, w = st.frame.shape[:2]
+                cv2.resize(frame, (w, h), dst=st.frame)
+                if not st.started:
+                    st.of.set1stFrame(st.frame)
+                    st.started = True
+                    continue
+
+                start = time.perf_counter()
+                img = st.of.apply(st.frame)
+                elapsed = time.perf_counter() - start
+
+                # publish through shared memory, or drop when the consumer holds every slot
+                if st.free.acquire(False):
+                    if img.ndim == 2:
+                        cv2.cvtColor(img, cv2.COLOR_GRAY2BGR, dst=st.ring[st.slot])
+                    else:
+                        np.copyto(st.ring[st.slot], img)
+                    results.put(('frame', st.sid, st.slot, elapsed))
+                    st.slot = (st.slot + 1) % st.ring.slots
+                else:
+                    results.put(('drop', st.sid, -1, elapsed))
+    except Exception:
+        results.put(('error', [sid for sid, source, spec in streams if sid not in ended], traceback.format_exc()))
+    finally:
+        for st in active:
+            st.vc.release()
+            st.ring.close()
+
+class StreamStats:
+    '''Frame rate and latency counters for one stream'''
+    def __init__(self, source):
+        self.source = source
+        self.frames = 0
+        self.drops = 0
+        self.apply_time = 0.0
+        self.window_frames = 0
+        self.window_start = time.perf_counter()
+        self.fps = 0.0
+        self.finished = False
+        self.failed = False
+
+    def update(self, elapsed, dropped):
+        self.frames += 1
+        self.window_frames += 1
+        self.drops += dropped
+        self.apply_time += elapsed
+
+    def roll(self, now):
+        '''Close the current measurement window and compute its fps'''
+        self.fps = self.window_frames / max(now - self.window_start, 1e-9)
+        self.window_frames = 0
+        self.window_start = now
+
+class MultiStreamServer:
+    '''Shards streams over worker processes, each stream with its own IOpticalFlow state.
+
+    Rendered frames come back through a SharedFrameRing per stream; only
+    small messages travel through the result queue.
+    '''
+    def __init__(self, sources, type='dense_hsv', workers=None, size=(320, 240), slots=3, loop=False,
+                 options=None, target_fps=None):
+        self.sources = list(sources)
+        self.type = type
+        self.options = options or {}
+        self.target_fps = target_fps
+        self.workers = min(workers or mp.cpu_count(), len(self.sources))
+        self.size = size
+        self.slots = slots
+        self.loop = loop
+        self.stats = [StreamStats(s) for s in self.sources]
+        self.rings = []
+        self.procs = []
+
+    def start(self):
+        w, h = self.size
+        self.rings = [SharedFrameRing((h, w, 3), np.uint8, self.slots) for _ in self.sources]
+        self.free = [mp.Semaphore(self.slots) for _ in self.sources]
+        self.results = mp.Queue()
+        self.stop_event = mp.Event()
+        shards = [[] for _ in range(self.workers)]
+        for sid, source in enumerate(self.sources):
+            shards[sid % self.workers].append((sid, source, self.rings[sid].spec()))
+        for shard in shards:
+            p = mp.Process(target=_worker, args=(shard, self.type, self.options, self.target_fps, self.free, self.results,
+                                                 self.stop_event, self.loop))
+            p.daemon = True
+            p.start()
+            self.procs.append(p)
+
+    def run(self, callback=None, report_interval=2.0, report=None):
+        '''Consume results until every stream ends or callback(sid, img) returns False.
+
+        img is a view into shared memory and is only valid during the callback.
+        '''
+        report = report or self.printReport
+        last_report = time.perf_counter()
+        running = len(self.sources)
+        while running:
+            try:
+                message = self.results.get(timeout=0.5)
+            except queue.Empty:
+                if not any(p.is_alive() for p in self.procs):
+                    break
+                message = None
+            if message is not None and message[0] == 'eof':
+                self.stats[message[1]].finished = True
+                running -= 1
+            elif message is not None and message[0] == 'error':
+                kind, sids, text = message
+                print('Worker of streams %s failed:\n%s' % (', '.join(str(sid) for sid in sids), text))
+                for sid in sids:
+                    self.stats[sid].failed = self.stats[sid].finished = True
+                running -= len(sids)
+            elif message is not None:
+                kind, sid, slot, elapsed = message
+                self.stats[sid].update(elapsed, kind == 'drop')
+                if kind == 'frame':
+                    keep_going = callback is None or callback(sid, self.rings[sid][slot]) is not False
+                    self.free[sid].release()
+                    if not keep_going:
+                        break
+            now = time.perf_counter()
+            if now - last_report >= report_interval:
+                for st in self.stats:
+                    st.roll(now)
+                report(self.stats)
+                last_report = now
+        now = time.perf_counter()
+        for st in self.stats:
+            st.roll(now)
+        report(self.stats)
+
+    def stop(self):
+        self.stop_event.set()
+        for p in self.procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        for ring in self.rings:
+            ring.close()
+            ring.unlink()
+        self.procs = []
+        self.rings = []
+
+    @staticmethod
+    def printReport(stats):
+        print('%-4s %-32s %8s %10s %8s' % ('id', 'source', 'fps', 'apply ms', 'dropped'))
+        for sid, st in enumerate(stats):
+            print('%-4d %-32s %8.1f %10.2f %8d%s' % (sid, st.source[-32:], st.fps,
+                                                    1000.0 * st.apply_time / max(st.frames, 1),
+                                                    st.drops, ' (failed)' if st.failed else
+                                                    ' (ended)' if st.finished else ''))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run optical flow over many cameras/videos in a process pool.')
+    parser.add_argument('sources', nargs='+', help='video files, URLs or camera indices')
+    parser.add_argument('-t', '--type', default='dense_hsv',
+                        help='dense_hsv, dense_lines, dense_warp or lucas_kanade (default: dense_hsv)')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes (default: CPU count)')
+    parser.add_argument('--size', default='320x240', help='processing size WxH (default: 320x240)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='compute dense flow at this fraction of the frame size (default: 1.0)')
+    parser.add_argument('--engine', help='dense flow engine: %s or auto (default: farneback)' % ', '.join(ENGINES))
+    parser.add_argument('--regions', metavar='MOTION_OR_MASK',
+                        help="compute dense flow only around moving areas ('motion') or where a mask image "
+                             "is nonzero, zero elsewhere")
+    parser.add_argument('--decimate', type=int, default=1,
+                        help='compute dense flow every N frames, extrapolate in between (default: 1)')
+    parser.add_argument('--max-error', type=float,
+                        help='with --decimate, adapt the interval to keep extrapolation within this many pixels')
+    parser.add_argument('--target-fps', type=float,
+                        help='adapt flow quality per stream to hold this frame rate')
+    parser.add_argument('--loop', action='store_true', help='rewind video files at the end')
+    parser.add_argument('--show', action='store_true', help='display each stream in a window')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between fps reports')
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.lower().split('x'))
+    server = MultiStreamServer(args.sources, args.type, args.workers, size, loop=args.loop,
+                               options=flowOptions(args), target_fps=args.target_fps)
+
+    def show(sid, img):
+        cv2.imshow('stream %d' % sid, img)
+        return cv2.waitKey(1) != 27 # exit on ESC
+
+    server.start()
+    try:
+        server.run(show if args.show else None, args.interval)
+    except KeyboardInterrupt:
+        print('Closing...')
+    finally:
+        server.stop()
+        if args.show:
+            cv2.destroyAllWindows()
+
+
+if __name__ == '__main__':
+    main()
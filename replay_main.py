@@ -0,0 +1,147 @@
+# Headless replay of a session recorded with main.py --record-session, with a per-frame timing trace
+
+## reference
+# - https://docs.python.org/3/library/profile.html
+
+import argparse
+import cProfile
+import json
+import pstats
+import time
+import numpy as np
+from OpticalFlowShowcase import *
+from FlowMetrics import StageMetrics, drawOverlay
+from FrameCache import FrameCache
+from SessionRecord import FRAME, SessionReader
+from main import change, printGate
+
+def replay(session, args, engine, native=False, trace=None):
+    '''Feed the recorded frames and keys through change()/apply() like main.py, without camera or display.
+
+    At native speed frames are fed no faster than they were recorded, otherwise
+    as fast as they are processed. Each frame appends a JSON line to trace:
+    frame index, recorded time, method key, apply time and the time of every
+    stage inside it, in milliseconds. Returns the apply times.
+    '''
+    metrics = StageMetrics()
+    cache = FrameCache()
+    showTimings = args.overlay
+    of = frame = None
+    method = '1'
+    times = []
+    index = -1
+    start = t0 = None
+    for kind, timestamp, value in session:
+        if kind != FRAME:
+            key = value
+            if key == 27:
+                break
+            elif key == ord('m'):
+                showTimings = not showTimings
+            elif ord('1') <= key <= ord('5') and frame is not None:
+                of = change(key, frame, args, engine, metrics, cache, of)
+                method = chr(key)
+            # 's' saves nothing here, and recorded frames are already flipped
+            continue
+
+        frame = value
+        index += 1
+        if t0 is None:
+            start, t0 = time.perf_counter(), timestamp
+        elif native:
+            time.sleep(max(0.0, (timestamp - t0) - (time.perf_counter() - start)))
+        cache.push(frame)
+        if of is None:
+            of = change('1', frame, args, engine, metrics, cache)
+            continue
+
+        before = dict((name, h.sum) for name, h in metrics.histograms.items())
+        with metrics.stage('apply'):
+            img = of.apply(frame)
+        if showTimings:
+            drawOverlay(img, metrics)
+        times.append(metrics.histograms['apply'].last)
+        if trace:
+            stages = dict((name, round(1000.0 * (h.sum - before.get(name, 0.0)), 3))
+                          for name, h in metrics.histograms.items() if h.sum != before.get(name, 0.0))
+            trace.write(json.dumps(dict(frame=index, t=round(timestamp - t0, 4), method=method,
+                                        apply_ms=stages.pop('apply'), stages=stages)) + '\n')
+    printGate(of)
+    return times
+
+def loadTrace(path):
+    '''Per-stage lists of milliseconds from a trace file, the apply time under 'apply' '''
+    stages = {}
+    with open(path) as f:
+        for line in f:
+            row = json.loads(line)
+            stages.setdefault('apply', []).append(row['apply_ms'])
+            for name, ms in row['stages'].items():
+                stages.setdefault(name, []).append(ms)
+    return stages
+
+def compareTraces(baseline, current):
+    '''Mean and p99 milliseconds per stage of two traces'''
+    print('%-12s %10s %10s %8s %10s %10s' % ('stage', 'base mean', 'mean', 'change', 'base p99', 'p99'))
+    for name in current:
+        new = current[name]
+        old = baseline.get(name)
+        if old:
+            print('%-12s %10.3f %10.3f %+7.1f%% %10.3f %10.3f' % (name, np.mean(old), np.mean(new),
+                                                              100.0 * (np.mean(new) / max(np.mean(old), 1e-9) - 1.0),
+                                                              np.percentile(old, 99), np.percentile(new, 99)))
+        else:
+            print('%-12s %10s %10.3f %8s %10s %10.3f' % (name, '-', np.mean(new), '', '-', np.percentile(new, 99)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded session headless and time every frame.')
+    parser.add_argument('session', help='session file from main.py --record-session')
+    parser.add_argument('--native', action='store_true', help='replay at the recorded speed, not as fast as possible')
+    parser.add_argument('--trace', help='write the per-frame timing trace (JSON lines) to this file')
+    parser.add_argument('--baseline', help='compare the trace with this earlier one, needs --trace')
+    parser.add_argument('--profile', help='run under cProfile and save the statistics to this file')
+    parser.add_argument('--engine', help='dense flow engine (default: the recorded one)')
+    parser.add_argument('--gate', type=float, help='motion gate threshold (default: the recorded one)')
+    parser.add_argument('--window', type=int, help='motion heatmap window (default: the recorded one)')
+    parser.add_argument('--target-fps', type=float,
+                        help='quality governor frame rate, 0 to turn it off (default: the recorded one)')
+    parser.add_argument('--overlay', action='store_true', help='start with per-stage timings drawn')
+    args = parser.parse_args()
+    if args.baseline and not args.trace:
+        parser.error('--baseline needs --trace')
+
+    session = SessionReader(args.session)
+    meta = session.meta
+    for name, default in (('engine', 'farneback'), ('gate', None), ('window', 30), ('target_fps', None)):
+        if getattr(args, name) is None:
+            setattr(args, name, meta.get(name, default))
+    engine = selectEngine() if args.engine == 'auto' else args.engine
+    print('Replaying %d frames (%.1f s recorded) with %s' % (session.frames, session.duration, engine))
+
+    trace = open(args.trace, 'w') if args.trace else None
+    profile = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    try:
+        if profile:
+            profile.enable()
+        times = replay(session, args, engine, args.native, trace)
+    finally:
+        if profile:
+            profile.disable()
+        if trace:
+            trace.close()
+    elapsed = time.perf_counter() - start
+
+    if times:
+        ms = 1000.0 * np.array(times)
+        print('Replayed %d frames in %.2f s: apply mean %.2f ms, p50 %.2f ms, p99 %.2f ms' %
+              (len(ms), elapsed, ms.mean(), np.percentile(ms, 50), np.percentile(ms, 99)))
+    if profile:
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(15)
+    if args.baseline:
+        compareTraces(loadTrace(args.baseline), loadTrace(args.trace))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+# Streaming server: rendered flow as MJPEG over HTTP and motion stats over WebSocket, for headless boxes
+
+## reference
+# - https://docs.python.org/3/library/asyncio-stream.html
+# - https://datatracker.ietf.org/doc/html/rfc6455 (WebSocket)
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import threading
+import time
+import numpy as np
+import cv2
+from OpticalFlowShowcase import *
+from FrameCapture import BACKENDS, ThreadedCapture, openCapture
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+BOUNDARY = b'frame'
+
+PAGE = b'''<!DOCTYPE html>
+<html><head><title>Optical flow</title></head>
+<body style="background:#222;color:#ddd;font-family:monospace">
+<img src="/stream.mjpg"><pre id="stats"></pre>
+<script>
+var ws = new WebSocket('ws://' + location.host + '/stats');
+ws.onmessage = function(e) {
+  var s = JSON.parse(e.data);
+  document.getElementById('stats').textContent = 'mean ' + s.mean.map(function(v) { return v.toFixed(2); }) +
+    '  magnitude ' + s.magnitude.toFixed(2) + '  direction ' + s.direction;
+};
+</script></body></html>
+'''
+
+def _plain(o):
+    '''json.dumps() default for NumPy values in motion stats'''
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(repr(o))
+
+class _Client:
+    '''One connected viewer, holding at most the newest undelivered message'''
+    def __init__(self):
+        self.queue = asyncio.Queue(1)
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, item):
+        if self.queue.full():
+            self.queue.get_nowait() # the viewer is behind, it only ever gets the newest
+            self.dropped += 1
+        self.queue.put_nowait(item)
+
+class StreamServer:
+    '''Serves / (viewer page), /stream.mjpg, /snapshot.jpg and /stats (WebSocket) from a thread.
+
+    publish() is called from the processing loop: the image is JPEG-encoded
+    once, only while someone watches, and handed to every client through a
+    queue of one, so a slow client skips frames and never blocks the caller.
+    '''
+    def __init__(self, host='0.0.0.0', port=8080, quality=80):
+        self.host = host
+        self.port = port
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.video = set()
+        self.stats = set()
+        self.jpeg = None # newest frame, for /snapshot.jpg and new viewers
+        self.encoded = 0
+        self.sent = 0    # totals of disconnected clients
+        self.dropped = 0
+        self.loop = None
+        self.tasks = set() # connection handlers, cancelled by stop()
+        self.closed = False
+
+    def start(self):
+        ready = threading.Event()
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            ready.set()
+            self.loop.run_forever()
+            self.loop.close()
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        '''Close every connection and the listening socket, then end the thread'''
+        if self.closed:
+            return
+        self.closed = True
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def _shutdown(self):
+        self.server.close()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def wantsStats(self):
+        return bool(self.stats)
+
+    def publish(self, img, stats=None):
+        '''Send a rendered image and optional motion stats to everybody connected'''
+        if self.closed:
+            return
+        jpeg = text = None
+        if self.video:
+            jpeg = cv2.imencode('.jpg', img, self.params)[1].tobytes()
+            self.encoded += 1
+        if self.stats and stats is not None:
+            text = json.dumps(stats, default=_plain)
+        if jpeg is not None or text is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._fanout, jpeg, text)
+            except RuntimeError: # stopped meanwhile
+                pass
+
+    def _fanout(self, jpeg, text):
+        if jpeg is not None:
+            self.jpeg = jpeg
+            for client in self.video:
+                client.offer(jpeg)
+        if text is not None:
+            for client in self.stats:
+                client.offer(text)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            lines = head.decode('latin-1').split('\r\n')
+            method, path = lines[0].split(' ')[:2]
+            headers = dict((k.strip().lower(), v.strip()) for k, _, v in
+                           (line.partition(':') for line in lines[1:] if line))
+            if method != 'GET':
+                await self._respond(writer, b'405 Method Not Allowed', b'text/plain', b'GET only\n')
+            elif path == '/':
+                await self._respond(writer, b'200 OK', b'text/html', PAGE)
+            elif path == '/snapshot.jpg' and self.jpeg is not None:
+                await self._respond(writer, b'200 OK', b'image/jpeg', self.jpeg)
+            elif path == '/stream.mjpg':
+                await self._mjpeg(writer)
+            elif path == '/stats' and headers.get('upgrade', '').lower() == 'websocket':
+                await self._websocket(reader, writer, headers['sec-websocket-key'])
+            else:
+                await self._respond(writer, b'404 Not Found', b'text/plain', b'not found\n')
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError):
+            pass
+        except asyncio.CancelledError:
+            pass # stop(), end the handler normally so the stream protocol does not log it
+        finally:
+            writer.close()
+            self.tasks.discard(task)
+
+    async def _respond(self, writer, status, kind, body):
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: ' + kind +
+                     b'\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+        await writer.drain()
+
+    async def _mjpeg(self, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=' + BOUNDARY +
+                     b'\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+        client = _Client()
+        if self.jpeg is not None:
+            client.offer(self.jpeg)
+        self.video.add(client)
+        try:
+            while True:
+                jpeg = await client.queue.get()
+                writer.write(b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+                             % len(jpeg) + jpeg + b'\r\n')
+                await writer.drain()
+                client.sent += 1
+        finally:
+            self.video.discard(client)
+            self._retire(client)
+
+    async def _websocket(self, reader, writer, key):
+        accept = base64.b64encode(hashlib.sha1(key.encode('latin-1') + WS_GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        await writer.drain()
+        client = _Client()
+        self.stats.add(client)
+        closed = asyncio.ensure_future(self._receive(reader))
+        getter = None
+        try:
+            while not closed.done():
+                getter = asyncio.ensure_future(client.queue.get())
+                await asyncio.wait([getter, closed], return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    break
+                payload = getter.result().encode('utf-8')
+                n = len(payload)
+                if n < 126:
+                    header = struct.pack('!BB', 0x81, n)
+                elif n < 65536:
+                    header = struct.pack('!BBH', 0x81, 126, n)
+                else:
+                    header = struct.pack('!BBQ', 0x81, 127, n)
+                writer.write(header + payload) # one text frame, servers do not mask
+                await writer.drain()
+                client.sent += 1
+        finally:
+            self.stats.discard(client)
+            self._retire(client)
+            pending = [f for f in (getter, closed) if f is not None and not f.done()]
+            for f in pending:
+                f.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _receive(self, reader):
+        '''Read client frames until it closes or drops, their content is not used'''
+        try:
+            while True:
+                b0, b1 = await reader.readexactly(2)
+                n = b1 & 0x7f
+                if n == 126:
+                    n = struct.unpack('!H', await reader.readexactly(2))[0]
+                elif n == 127:
+                    n = struct.unpack('!Q', await reader.readexactly(8))[0]
+                await reader.readexactly(n + (4 if b1 & 0x80 else 0))
+                if b0 & 0x0f == 0x8: # close
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError): # gone without a close frame
+            return
+
+    def _retire(self, client):
+        self.sent += client.sent
+        self.dropped += client.dropped
+
+    def report(self):
+        clients = list(self.video) + list(self.stats)
+        return dict(video=len(self.video), stats=len(self.stats), encoded=self.encoded,
+                    sent=self.sent + sum(c.sent for c in clients),
+                    dropped=self.dropped + sum(c.dropped for c in clients))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run an optical flow showcase headless and stream it over HTTP.')
+    parser.add_argument('-t', '--type', default='dense_hsv', help='%s (default: dense_hsv)' % ', '.join(TYPES))
+    parser.add_argument('--backend', default='opencv', choices=sorted(BACKENDS), help='capture backend (default: opencv)')
+    parser.add_argument('--source', help='camera index, video file/URL or synthetic sequence name')
+    parser.add_argument('--size', help='capture size WxH for cameras (default: native for OpenCV cameras, '
+                                       'else 320x240)')
+    parser.add_argument('--gray', action='store_true', help='capture gray frames')
+    parser.add_argument('--flip', action='store_true', help='flip image horizontally')
+    parser.add_argument('--host', default='0.0.0.0', help='listen address (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=8080, help='listen port (default: 8080)')
+    parser.add_argument('--quality', type=int, default=80, help='JPEG quality (default: 80)')
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.lower().split('x')) if args.size else None
+    vc = openCapture(args.backend, args.source, size, args.gray)
+    if not vc.isOpened():
+        parser.error('cannot open %s capture' % args.backend)
+    cap = ThreadedCapture(vc, args.flip)
+    server = StreamServer(args.host, args.port, args.quality).start()
+    print('Streaming on http://%s:%d/' % (args.host, args.port))
+
+    of = CreateOpticalFlow(args.type)
+    rval, frame = cap.read()
+    if rval:
+        of.set1stFrame(frame)
+    last = time.time()
+    try:
+        while rval:
+            rval, frame = cap.read()
+            if not rval:
+                break
+            if server.wantsStats():
+                result = of.analyze(frame, render=True)
+                server.publish(result['image'], result['stats'])
+            else:
+                server.publish(of.apply(frame))
+            if time.time() - last >= 10.0:
+                print('clients %(video)d video, %(stats)d stats; %(encoded)d frames encoded, '
+                      '%(sent)d sent, %(dropped)d dropped' % server.report())
+                last = time.time()
+    except KeyboardInterrupt:
+        print('Closing...')
+    finally:
+        server.stop()
+        cap.release()
+
+
+if __name__ == '__main__':
+    main()